@@ -0,0 +1,38 @@
+"""
+Per-request cost of verifying an access token, with and without the
+verified token cache.
+
+    python -m benchmarks.auth [-n NUMBER]
+"""
+import os
+
+os.environ.setdefault("SECRET", "benchmark-secret-" + "0" * 32)
+
+from kokomemo.auth import get_new_tokens, verify_token, token_cache  # noqa
+from argparse import ArgumentParser  # noqa
+from timeit import timeit  # noqa
+
+
+def uncached(token: str) -> None:
+    token_cache.clear()
+    verify_token(token)
+
+
+def main() -> None:
+    parser = ArgumentParser(prog="python -m benchmarks.auth")
+    parser.add_argument("-n", "--number", type=int, default=20000)
+    args = parser.parse_args()
+
+    access_token, _ = get_new_tokens("user", "session", "refresh")
+    verify_token(access_token)
+
+    before = timeit(lambda: uncached(access_token), number=args.number)
+    after = timeit(lambda: verify_token(access_token), number=args.number)
+
+    print(f"uncached: {before / args.number * 1e6:8.2f} us/request")
+    print(f"cached:   {after / args.number * 1e6:8.2f} us/request")
+    print(f"speedup:  {before / after:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
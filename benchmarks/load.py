@@ -0,0 +1,541 @@
+"""
+Seeds users, walls and memos, then drives the API with concurrent clients
+and reports throughput and latency percentiles per route. Runs against an
+in-process mongomock-motor database unless --mongodb-url is given.
+
+    pip install -r benchmarks/requirements.txt
+    python -m benchmarks.load [--mongodb-url URL] [--duration SECONDS]
+        [--users N] [--walls N] [--memos N] [--concurrency N]
+        [--baseline FILE [--tolerance FRACTION]] [--save-baseline FILE]
+
+With --baseline, exits with 1 if any route's p50 or p95 got slower than
+the baseline by more than the tolerance. Baselines only compare against
+runs on the same machine and backend, so record them where CI runs.
+"""
+import os
+
+os.environ.setdefault("SECRET", "benchmark-secret-" + "0" * 32)
+# For the test login route
+os.environ.setdefault("KOKOMEMO_DEBUG", "true")
+os.environ.setdefault("DBNAME", "kokomemo_benchmark")
+os.environ.setdefault("ACCESS_LOG", "false")
+os.environ.setdefault("LOGLEVEL", "WARNING")
+
+import kokomemo.db as db  # noqa
+from kokomemo import app  # noqa
+from kokomemo.auth import get_new_id, user_cache  # noqa
+from kokomemo.config import config  # noqa
+from kokomemo.models import Memo, Wall  # noqa
+from argparse import ArgumentParser  # noqa
+from dataclasses import dataclass, field  # noqa
+from collections.abc import Awaitable, Callable  # noqa
+from datetime import datetime, timedelta, UTC  # noqa
+from time import perf_counter  # noqa
+import asyncio  # noqa
+import httpx  # noqa
+import json  # noqa
+import random  # noqa
+import sys  # noqa
+
+WORDS = (
+    "meeting groceries idea call email draft review deadline travel book "
+    "recipe birthday project budget invoice design bug release notes plan "
+    "garden movie music workout doctor ticket backup password reminder"
+).split()
+
+# Fewer memos kept per wall than seeded, so deletes can't run a wall dry
+MIN_MEMOS = 10
+
+
+@dataclass
+class Client:
+    id: str
+    access_token: str
+    refresh_token: str
+    walls: list[str] = field(default_factory=list)
+    memos: dict[str, list[str]] = field(default_factory=dict)
+    etags: dict[str, str] = field(default_factory=dict)
+
+    @property
+    def headers(self) -> dict[str, str]:
+        return {"Authorization": f"Bearer {self.access_token}"}
+
+
+Scenario = Callable[[httpx.AsyncClient, Client, random.Random], Awaitable]
+
+
+class Recorder:
+    def __init__(self):
+        self.samples: dict[str, list[float]] = {}
+        self.errors: dict[str, int] = {}
+        self.recording = False
+
+    async def request(
+        self, http: httpx.AsyncClient, name: str, method: str, url: str,
+        expect: tuple[int, ...] = (200,), **kwargs
+    ) -> httpx.Response:
+        start = perf_counter()
+        response = await http.request(method, url, **kwargs)
+        elapsed = perf_counter() - start
+
+        if self.recording:
+            self.samples.setdefault(name, []).append(elapsed)
+            if response.status_code not in expect:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+        return response
+
+
+recorder = Recorder()
+
+
+def content(rng: random.Random) -> str:
+    return " ".join(rng.choices(WORDS, k=rng.randint(3, 40)))
+
+
+async def get_memos(http, client, rng):
+    wall = rng.choice(client.walls)
+    response = await recorder.request(
+        http, "GET /walls/{id}/memos", "GET",
+        f"/api/v1/walls/{wall}/memos", headers=client.headers
+    )
+    client.etags[wall] = response.headers.get("etag", "")
+
+    cursor = response.json()['meta']['next_cursor']
+    if cursor and rng.random() < 0.5:
+        await recorder.request(
+            http, "GET /walls/{id}/memos?after", "GET",
+            f"/api/v1/walls/{wall}/memos", headers=client.headers,
+            params={"after": cursor}
+        )
+
+
+async def get_memos_cached(http, client, rng):
+    wall = rng.choice(client.walls)
+    if wall not in client.etags:
+        return await get_memos(http, client, rng)
+
+    await recorder.request(
+        http, "GET /walls/{id}/memos If-None-Match", "GET",
+        f"/api/v1/walls/{wall}/memos", expect=(200, 304),
+        headers={**client.headers, "If-None-Match": client.etags[wall]}
+    )
+
+
+async def get_walls(http, client, rng):
+    await recorder.request(
+        http, "GET /walls", "GET", "/api/v1/walls", headers=client.headers
+    )
+
+
+async def edit_wall(http, client, rng):
+    await recorder.request(
+        http, "PUT /walls", "PUT", "/api/v1/walls", headers=client.headers,
+        json={"id": rng.choice(client.walls), "name": rng.choice(WORDS)}
+    )
+
+
+async def create_and_delete_wall(http, client, rng):
+    response = await recorder.request(
+        http, "POST /walls", "POST", "/api/v1/walls", headers=client.headers,
+        json={"name": rng.choice(WORDS), "colour": rng.randrange(1 << 24)}
+    )
+    wall = response.json()['data']['id']
+    response = await recorder.request(
+        http, "DELETE /walls/{id}", "DELETE", f"/api/v1/walls/{wall}",
+        headers=client.headers
+    )
+    job = response.json()['data']['id']
+    await recorder.request(
+        http, "GET /jobs/{id}", "GET", f"/api/v1/jobs/{job}",
+        headers=client.headers
+    )
+
+
+async def post_memo(http, client, rng):
+    wall = rng.choice(client.walls)
+    response = await recorder.request(
+        http, "POST /walls/{id}/memos", "POST", f"/api/v1/walls/{wall}/memos",
+        headers=client.headers, json={"content": content(rng)}
+    )
+    client.memos[wall].append(response.json()['data']['id'])
+
+
+async def post_memos_batch(http, client, rng):
+    wall = rng.choice(client.walls)
+    response = await recorder.request(
+        http, "POST /walls/{id}/memos/batch", "POST",
+        f"/api/v1/walls/{wall}/memos/batch", headers=client.headers,
+        json={"memos": [{"content": content(rng)} for _ in range(10)]}
+    )
+    client.memos[wall].extend(memo['id'] for memo in response.json()['data'])
+
+
+async def edit_memo(http, client, rng):
+    wall = rng.choice(client.walls)
+    await recorder.request(
+        http, "PUT /walls/{id}/memos", "PUT", f"/api/v1/walls/{wall}/memos",
+        headers=client.headers,
+        json={"id": rng.choice(client.memos[wall]), "content": content(rng)}
+    )
+
+
+async def move_memos(http, client, rng):
+    wall = rng.choice(client.walls)
+    memo, after = rng.sample(client.memos[wall], 2)
+    await recorder.request(
+        http, "PUT /walls/{id}/memos/move", "PUT",
+        f"/api/v1/walls/{wall}/memos/move", headers=client.headers,
+        json={"ids": [memo], "after": after}
+    )
+
+
+async def delete_memo(http, client, rng):
+    wall = rng.choice(client.walls)
+    if len(client.memos[wall]) <= MIN_MEMOS:
+        return await post_memo(http, client, rng)
+
+    memo = client.memos[wall].pop(rng.randrange(len(client.memos[wall])))
+    await recorder.request(
+        http, "DELETE /walls/{id}/memos/{id}", "DELETE",
+        f"/api/v1/walls/{wall}/memos/{memo}", headers=client.headers
+    )
+
+
+async def search(http, client, rng):
+    await recorder.request(
+        http, "GET /walls/search", "GET", "/api/v1/walls/search",
+        headers=client.headers, params={"q": rng.choice(WORDS)}
+    )
+
+
+async def sync(http, client, rng):
+    await recorder.request(
+        http, "GET /sync", "GET", "/api/v1/sync", headers=client.headers,
+        params={"limit": 100}
+    )
+
+
+async def export(http, client, rng):
+    await recorder.request(
+        http, "GET /export", "GET", "/api/v1/export", headers=client.headers
+    )
+
+
+async def import_memos(http, client, rng):
+    wall = rng.choice(client.walls)
+    records = "\n".join(
+        json.dumps({"type": "memo", "data": {
+            "wall_id": wall, "content": content(rng)
+        }}) for _ in range(5)
+    )
+    await recorder.request(
+        http, "POST /import", "POST", "/api/v1/import", headers=client.headers,
+        files={"file": ("import.ndjson", records, "application/x-ndjson")}
+    )
+
+
+async def get_userinfo(http, client, rng):
+    await recorder.request(
+        http, "GET /user/info", "GET", "/api/v1/user/info",
+        headers=client.headers
+    )
+
+
+async def put_userinfo(http, client, rng):
+    await recorder.request(
+        http, "PUT /user/info", "PUT", "/api/v1/user/info",
+        headers=client.headers, json={"name": rng.choice(WORDS)}
+    )
+
+
+async def refresh(http, client, rng):
+    response = await recorder.request(
+        http, "POST /user/token/refresh", "POST",
+        "/api/v1/user/login/token/refresh",
+        json={"token": client.refresh_token}
+    )
+    tokens = response.json()['data']
+    client.access_token = tokens['access_token']
+    client.refresh_token = tokens['refresh_token']
+
+
+async def login(http, client, rng):
+    # A new session each time, the client keeps using its first one
+    await recorder.request(
+        http, "POST /user/login/test", "POST", "/api/v1/user/login/test",
+        json={"email": f"{client.id}@benchmark.invalid"}
+    )
+
+
+# (scenario, weight, needs a real MongoDB)
+SCENARIOS: list[tuple[Scenario, int, bool]] = [
+    (get_memos, 30, False),
+    (get_memos_cached, 10, False),
+    (get_walls, 10, False),
+    (get_userinfo, 5, False),
+    (post_memo, 10, False),
+    (post_memos_batch, 2, False),
+    (edit_memo, 8, False),
+    (move_memos, 3, False),
+    (delete_memo, 3, False),
+    (search, 5, True),
+    (sync, 3, False),
+    (refresh, 3, False),
+    (edit_wall, 1, False),
+    (put_userinfo, 1, False),
+    (create_and_delete_wall, 1, False),
+    (import_memos, 1, False),
+    (export, 1, False),
+    (login, 1, False)
+]
+
+
+async def seed(
+    http: httpx.AsyncClient, users: int, walls: int, memos: int,
+    rng: random.Random
+) -> list[Client]:
+    clients = []
+    now = datetime.now(UTC)
+
+    for number in range(users):
+        email = f"user{number}@benchmark.invalid"
+        response = await http.post(
+            "/api/v1/user/login/test", json={"email": email}
+        )
+        response.raise_for_status()
+        tokens = response.json()['data']
+        response = await http.get(
+            "/api/v1/user/info",
+            headers={"Authorization": f"Bearer {tokens['access_token']}"}
+        )
+        client = Client(
+            id=response.json()['data']['id'],
+            access_token=tokens['access_token'],
+            refresh_token=tokens['refresh_token']
+        )
+
+        user_walls = [
+            Wall(id=get_new_id(), user_id=client.id, name=rng.choice(WORDS),
+                 colour=rng.randrange(1 << 24), memo_count=memos,
+                 last_memo_at=now - timedelta(minutes=1))
+            for _ in range(walls)
+        ]
+        if user_walls:
+            await db.get_collection("walls").insert_many(
+                [wall.model_dump() for wall in user_walls]
+            )
+
+        for wall in user_walls:
+            documents = [
+                Memo(
+                    id=get_new_id(), user_id=client.id, wall_id=wall.id,
+                    content=content(rng), index=float(index + 1),
+                    created_at=now - timedelta(minutes=memos - index),
+                    modified_at=now - timedelta(minutes=memos - index)
+                ).model_dump()
+                for index in range(memos)
+            ]
+            if documents:
+                await db.get_collection("memos").insert_many(documents)
+            client.walls.append(wall.id)
+            client.memos[wall.id] = [memo['id'] for memo in documents]
+
+        clients.append(client)
+
+    user_cache.clear()
+    return clients
+
+
+async def drive(
+    http: httpx.AsyncClient, clients: list[Client], scenarios, concurrency: int,
+    duration: float, warmup: float, rng: random.Random
+) -> float:
+    # Each client is used by one worker at a time, refresh tokens are single use
+    idle: asyncio.Queue[Client] = asyncio.Queue()
+    for client in clients:
+        idle.put_nowait(client)
+
+    functions = [scenario for scenario, _, _ in scenarios]
+    weights = [weight for _, weight, _ in scenarios]
+    deadline = perf_counter() + warmup + duration
+
+    async def worker():
+        while perf_counter() < deadline:
+            client = await idle.get()
+            try:
+                scenario, = rng.choices(functions, weights)
+                await scenario(http, client, rng)
+            finally:
+                idle.put_nowait(client)
+
+    async def start_recording():
+        await asyncio.sleep(warmup)
+        recorder.recording = True
+
+    started = asyncio.create_task(start_recording())
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    await started
+    return duration
+
+
+def percentile(ordered: list[float], fraction: float) -> float:
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def summarize(duration: float) -> dict:
+    results = {}
+    for name, samples in sorted(recorder.samples.items()):
+        ordered = sorted(samples)
+        results[name] = {
+            "count": len(ordered),
+            "errors": recorder.errors.get(name, 0),
+            "rps": len(ordered) / duration,
+            "p50": percentile(ordered, .50) * 1000,
+            "p95": percentile(ordered, .95) * 1000,
+            "p99": percentile(ordered, .99) * 1000
+        }
+    return results
+
+
+def report(results: dict, duration: float) -> None:
+    width = max(map(len, results), default=10)
+    print(f"{'route':<{width}} {'count':>7} {'errors':>6} {'rps':>8} "
+          f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for name, result in results.items():
+        print(f"{name:<{width}} {result['count']:>7} {result['errors']:>6} "
+              f"{result['rps']:>8.1f} {result['p50']:>8.2f} "
+              f"{result['p95']:>8.2f} {result['p99']:>8.2f}")
+
+    total = sum(result['count'] for result in results.values())
+    print(f"\n{total} requests in {duration:.1f}s, {total / duration:.1f} rps")
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    regressions = []
+    for name, base in baseline['routes'].items():
+        if name not in results:
+            continue
+        for key in ("p50", "p95"):
+            if results[name][key] > base[key] * (1 + tolerance):
+                regressions.append(
+                    f"{name} {key}: {results[name][key]:.2f} ms, "
+                    f"baseline {base[key]:.2f} ms"
+                )
+    return regressions
+
+
+def use_mongomock() -> None:
+    from mongomock_motor import AsyncMongoMockClient, AsyncMongoMockCollection
+    from mongomock import collection as mock_collection
+    from pymongo import InsertOne, UpdateOne
+
+    # mongomock_motor returns a synchronous collection from with_options,
+    # and its bulk_write doesn't take the arguments pymongo does
+    def with_options(self, *args, **kwargs):
+        collection = self._AsyncMongoMockCollection__collection
+        return AsyncMongoMockCollection(
+            self.database, collection.with_options(*args, **kwargs)
+        )
+
+    async def bulk_write(self, requests, ordered=True, **kwargs):
+        for request in requests:
+            if isinstance(request, UpdateOne):
+                await self.update_one(request._filter, request._doc)
+            elif isinstance(request, InsertOne):
+                await self.insert_one(request._doc)
+            else:
+                raise NotImplementedError(type(request).__name__)
+
+    # MongoDB sorts null below everything else, mongomock's $max can't
+    # compare it at all
+    def max_updater(doc, field_name, value):
+        current = doc.get(field_name)
+        doc[field_name] = value if current is None else max(current, value)
+
+    AsyncMongoMockCollection.with_options = with_options
+    AsyncMongoMockCollection.bulk_write = bulk_write
+    mock_collection._updaters['$max'] = max_updater
+
+    db.client = AsyncMongoMockClient()
+    db.db = db.client[config.dbname]
+
+
+async def run(args) -> int:
+    rng = random.Random(args.seed)
+
+    if args.mongodb_url:
+        if not config.dbname.endswith("_benchmark"):
+            print(f"Refusing to wipe {config.dbname}, set DBNAME to a name "
+                  "ending in _benchmark", file=sys.stderr)
+            return 2
+        await db.db_connect(args.mongodb_url)
+        await db.client.drop_database(config.dbname)
+    else:
+        use_mongomock()
+
+    scenarios = [
+        scenario for scenario in SCENARIOS
+        if args.mongodb_url or not scenario[2]
+    ]
+
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://benchmark"
+        ) as http:
+            clients = await seed(
+                http, args.users, args.walls, args.memos, rng
+            )
+            duration = await drive(
+                http, clients, scenarios, args.concurrency,
+                args.duration, args.warmup, rng
+            )
+
+    results = summarize(duration)
+    report(results, duration)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as file:
+            json.dump({"routes": results}, file, indent=2)
+
+    failed = [name for name, result in results.items() if result['errors']]
+    if failed:
+        print(f"\nRoutes with errors: {', '.join(failed)}", file=sys.stderr)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        if regressions:
+            print("\nRegressions:", *regressions, sep="\n  ", file=sys.stderr)
+            return 1
+        print("\nNo regressions against the baseline")
+
+    return 1 if failed else 0
+
+
+def main() -> None:
+    parser = ArgumentParser(prog="python -m benchmarks.load")
+    parser.add_argument("--mongodb-url", default=None,
+                        help="run against this MongoDB, wiping DBNAME")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--walls", type=int, default=5)
+    parser.add_argument("--memos", type=int, default=200,
+                        help="memos per wall")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--warmup", type=float, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--save-baseline")
+    args = parser.parse_args()
+
+    if args.memos <= MIN_MEMOS:
+        parser.error(f"--memos must be more than {MIN_MEMOS}")
+
+    sys.exit(asyncio.run(run(args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Cost of serializing a page of memos, going through the response models
+the way FastAPI does versus straight from the raw documents.
+
+    python -m benchmarks.serialization [-n NUMBER] [--size SIZE]
+"""
+import os
+
+os.environ.setdefault("SECRET", "benchmark-secret-" + "0" * 32)
+
+from kokomemo.api.v1.memo import ResponseMemo, MemoPageResponse  # noqa
+from kokomemo.api.v1.models import CursorMeta, envelope  # noqa
+from pydantic import TypeAdapter  # noqa
+from argparse import ArgumentParser  # noqa
+from datetime import datetime, timedelta, UTC  # noqa
+from timeit import timeit  # noqa
+
+adapter = TypeAdapter(MemoPageResponse)
+
+
+def make_page(size: int) -> list[dict]:
+    now = datetime.now(UTC).replace(microsecond=0)
+    return [
+        {
+            "_id": index,
+            "id": f"memo{index:08d}",
+            "user_id": "user00000000",
+            "wall_id": "wall00000000",
+            "content": f"memo number {index} " * 8,
+            "index": float(size - index),
+            "created_at": now - timedelta(minutes=index),
+            "modified_at": now - timedelta(seconds=index)
+        }
+        for index in range(size)
+    ]
+
+
+def models(page: list[dict], meta: CursorMeta) -> bytes:
+    response = MemoPageResponse(
+        data=[ResponseMemo(**memo) for memo in page], meta=meta
+    )
+    # FastAPI validates the returned object against the annotation again
+    return adapter.dump_json(adapter.validate_python(response))
+
+
+def raw(page: list[dict], meta: CursorMeta) -> bytes:
+    return envelope(meta, ResponseMemo, page).body
+
+
+def main() -> None:
+    parser = ArgumentParser(prog="python -m benchmarks.serialization")
+    parser.add_argument("-n", "--number", type=int, default=2000)
+    parser.add_argument("--size", type=int, default=100)
+    args = parser.parse_args()
+
+    page = make_page(args.size)
+    meta = CursorMeta(message="Memos successfully fetched", next_cursor="x")
+
+    before = timeit(lambda: models(page, meta), number=args.number)
+    after = timeit(lambda: raw(page, meta), number=args.number)
+
+    print(f"models: {before / args.number * 1e6:8.2f} us/page")
+    print(f"raw:    {after / args.number * 1e6:8.2f} us/page")
+    print(f"speedup: {before / after:7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,44 @@
 from .api import router as api
-from .db import db_connect
+from .db import db_connect, close_db, health
+from .migrations import ensure_indexes
+from .auth import watch_users
+from .jobs import watch_jobs, stop_jobs
+from .google_auth import executor as google_executor
+from .middleware import AccessLogMiddleware
+from .metrics import MetricsMiddleware, render as render_metrics
+from .config import config
 from .logger import logger
-from fastapi import FastAPI, Request
-from fastapi.responses import PlainTextResponse
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, suppress
+import asyncio
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await db_connect()
+    if config.auto_index:
+        await ensure_indexes()
+
+    watchers = [asyncio.create_task(watch_jobs())]
+    if config.user_cache_watch:
+        watchers.append(asyncio.create_task(watch_users()))
+
     yield
 
+    for watcher in watchers:
+        watcher.cancel()
+        with suppress(asyncio.CancelledError):
+            await watcher
 
-app = FastAPI(lifespan=lifespan)
+    await stop_jobs()
 
+    google_executor.shutdown(wait=False)
+    close_db()
 
-@app.middleware("http")
-async def log_middleware(request: Request, call_next):
-    logger.debug("%s: %s", request.method, request.headers)
-    response = await call_next(request)
-    logger.debug("%s: %s", response.status_code, response.headers)
-    return response
+
+app = FastAPI(lifespan=lifespan)
 
 
 app.add_middleware(
@@ -32,9 +49,16 @@ app.add_middleware(
     ],
     allow_credentials=True,
     allow_methods=["*"],
-    allow_headers=["*"]
+    allow_headers=["*"],
+    expose_headers=["ETag", "X-Request-ID"]
 )
 
+if config.metrics:
+    app.add_middleware(MetricsMiddleware)
+
+# Added last so it wraps everything, CORS included
+app.add_middleware(AccessLogMiddleware)
+
 app.include_router(
     api,
     prefix="/api"
@@ -44,3 +68,20 @@ app.include_router(
 @app.get("/")
 async def meow():
     return PlainTextResponse("ああ！夏を今もう一回！！")
+
+
+@app.get("/health", include_in_schema=False)
+async def get_health():
+    try:
+        return await health()
+    except Exception as e:
+        logger.warning("Health check failed: %s", e)
+        return JSONResponse({"error": str(e)}, status_code=503)
+
+
+if config.metrics:
+    @app.get("/metrics", include_in_schema=False)
+    async def metrics():
+        return PlainTextResponse(
+            render_metrics(), media_type="text/plain; version=0.0.4"
+        )
@@ -0,0 +1,36 @@
+from .db import db_connect
+from .migrations import (
+    ensure_indexes, migrate_sessions, migrate_walls, sweep_orphans,
+    repair_usage, reconcile_walls
+)
+from argparse import ArgumentParser
+import asyncio
+
+COMMANDS = {
+    "indexes": ensure_indexes,
+    "migrate-sessions": migrate_sessions,
+    "migrate-walls": migrate_walls,
+    "sweep-orphans": sweep_orphans,
+    "repair-usage": repair_usage,
+    "reconcile-walls": reconcile_walls
+}
+
+
+async def run(command: str) -> None:
+    await db_connect()
+    await COMMANDS[command]()
+
+
+def main() -> None:
+    parser = ArgumentParser(
+        prog="python -m kokomemo",
+        description="Maintenance tasks to run ahead of a deploy"
+    )
+    parser.add_argument("command", choices=COMMANDS)
+    args = parser.parse_args()
+
+    asyncio.run(run(args.command))
+
+
+if __name__ == "__main__":
+    main()
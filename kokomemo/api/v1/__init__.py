@@ -1,5 +1,10 @@
 from .user import router as user
 from .memo import router as memo
+from .search import router as search
+from .export import router as export
+from .importer import router as importer
+from .jobs import router as jobs
+from .sync import router as sync
 from fastapi import APIRouter
 
 router = APIRouter()
@@ -10,8 +15,38 @@ router.include_router(
     tags=["user"]
 )
 
+router.include_router(
+    search,
+    prefix="/walls/search",
+    tags=["memo"]
+)
+
 router.include_router(
     memo,
     prefix="/walls",
     tags=["memo"]
 )
+
+router.include_router(
+    export,
+    prefix="/export",
+    tags=["export"]
+)
+
+router.include_router(
+    importer,
+    prefix="/import",
+    tags=["export"]
+)
+
+router.include_router(
+    jobs,
+    prefix="/jobs",
+    tags=["jobs"]
+)
+
+router.include_router(
+    sync,
+    prefix="/sync",
+    tags=["sync"]
+)
@@ -0,0 +1,121 @@
+from kokomemo.dependencies.auth import LoginInfo, user_depends
+from kokomemo.db import collection_depends
+from kokomemo.models import Wall, Memo, UserView
+from motor.motor_asyncio import AsyncIOMotorCollection as Collection
+from pymongo import ASCENDING, DESCENDING
+from fastapi import APIRouter, Depends
+from fastapi.responses import StreamingResponse
+from pydantic import Field
+from pydantic.json_schema import SkipJsonSchema
+from collections.abc import AsyncIterator
+from enum import Enum
+from typing import Annotated
+import zlib
+
+router = APIRouter()
+
+# Memos fetched per round trip, and bytes buffered before each write
+EXPORT_BATCH = 1000
+CHUNK_SIZE = 64 * 1024
+
+
+class ExportFormat(str, Enum):
+    ndjson = "ndjson"
+    json = "json"
+
+
+class ExportWall(Wall):
+    user_id: SkipJsonSchema[str] = Field(default="", exclude=True)
+
+
+class ExportMemo(Memo):
+    user_id: SkipJsonSchema[str] = Field(default="", exclude=True)
+
+
+async def export_records(
+    login: LoginInfo, walls: Collection, memos: Collection
+) -> AsyncIterator[bytes]:
+    cursor = walls.find({"user_id": login.user.id}).sort([
+        ("created_at", ASCENDING), ("id", ASCENDING)
+    ])
+
+    async for wall in cursor:
+        data = ExportWall(**wall).model_dump_json().encode()
+        yield b'{"type":"wall","data":%s}' % data
+
+    # Follows the (user_id, wall_id, index, id) index so nothing is sorted
+    # in memory, however many memos there are
+    cursor = memos.find({"user_id": login.user.id}).sort([
+        ("wall_id", ASCENDING), ("index", DESCENDING), ("id", DESCENDING)
+    ]).batch_size(EXPORT_BATCH)
+
+    async for memo in cursor:
+        data = ExportMemo(**memo).model_dump_json().encode()
+        yield b'{"type":"memo","data":%s}' % data
+
+
+async def frame(
+    records: AsyncIterator[bytes], format: ExportFormat
+) -> AsyncIterator[bytes]:
+    if format == ExportFormat.ndjson:
+        async for record in records:
+            yield record + b"\n"
+        return
+
+    separator = b"["
+    async for record in records:
+        yield separator + record
+        separator = b","
+    yield b"[]" if separator == b"[" else b"]"
+
+
+async def encode(
+    chunks: AsyncIterator[bytes], compress: bool
+) -> AsyncIterator[bytes]:
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    buffer = bytearray()
+
+    async for chunk in chunks:
+        buffer += chunk
+        if len(buffer) >= CHUNK_SIZE:
+            yield compressor.compress(buffer) if compressor else bytes(buffer)
+            buffer.clear()
+
+    if compressor:
+        yield compressor.compress(buffer) + compressor.flush()
+    elif buffer:
+        yield bytes(buffer)
+
+
+@router.get("", response_class=StreamingResponse)
+async def export(
+    login: Annotated[LoginInfo, Depends(user_depends(UserView))],
+    walls: Annotated[
+        Collection, Depends(collection_depends("walls", read_only=True))
+    ],
+    memos: Annotated[
+        Collection, Depends(collection_depends("memos", read_only=True))
+    ],
+    format: ExportFormat = ExportFormat.ndjson,
+    compress: bool = False
+) -> StreamingResponse:
+    """
+    Streams every wall followed by every memo as
+    `{"type": "wall" | "memo", "data": {...}}` records
+    """
+
+    filename = f"kokomemo-{login.user.id}.{format.value}"
+    media_type = {
+        ExportFormat.ndjson: "application/x-ndjson",
+        ExportFormat.json: "application/json"
+    }[format]
+
+    if compress:
+        filename += ".gz"
+        media_type = "application/gzip"
+
+    return StreamingResponse(
+        encode(frame(export_records(login, walls, memos), format), compress),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
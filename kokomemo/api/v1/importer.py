@@ -0,0 +1,351 @@
+from kokomemo.dependencies.auth import LoginInfo, user_depends
+from kokomemo.api.v1.models import BaseResponse, Meta
+from kokomemo.api.v1.memo import PostWall, PostMemo
+from kokomemo.auth import get_new_id
+from kokomemo.db import collection_depends
+from kokomemo.memos import (
+    insert_memos, next_index, bump_wall_version, charge_usage, content_size
+)
+from kokomemo.models import Wall, Memo, UserView
+from motor.motor_asyncio import AsyncIOMotorCollection as Collection
+from pymongo.errors import BulkWriteError
+from fastapi import APIRouter, Depends, UploadFile
+from pydantic import BaseModel, ValidationError
+from collections.abc import AsyncIterator
+from codecs import getincrementaldecoder
+from typing import Annotated, Any
+import json
+import math
+
+router = APIRouter()
+
+READ_SIZE = 64 * 1024
+# Longest single record accepted, so a broken file can't exhaust memory
+MAX_RECORD = 1024 * 1024
+# Memos written per insert_many
+IMPORT_BATCH = 1000
+MAX_ERRORS = 1000
+# Past this, adding 1 to an index no longer changes it and new memos can't
+# go on top. NaN and infinities are rejected along with it.
+MAX_INDEX = 2.0 ** 52
+
+Parsed = tuple[Any, str | None]
+
+
+class RecordError(BaseModel):
+    record: int
+    error: str
+
+
+class ImportResult(BaseModel):
+    walls: int = 0
+    memos: int = 0
+    errors: list[RecordError] = []
+
+
+class ImportResponse(BaseResponse):
+    data: ImportResult
+
+
+async def read_text(file: UploadFile) -> AsyncIterator[str]:
+    decoder = getincrementaldecoder("utf-8")(errors="replace")
+
+    while chunk := await file.read(READ_SIZE):
+        yield decoder.decode(chunk)
+
+    yield decoder.decode(b"", final=True)
+
+
+async def read_ndjson(text: AsyncIterator[str]) -> AsyncIterator[Parsed]:
+    def parse(line: str) -> Parsed:
+        try:
+            return json.loads(line), None
+        except json.JSONDecodeError as e:
+            return None, f"Invalid JSON: {e.msg}"
+
+    buffer = ""
+
+    async for chunk in text:
+        buffer += chunk
+        *lines, buffer = buffer.split("\n")
+
+        for line in lines:
+            if line.strip():
+                yield parse(line)
+
+        if len(buffer) > MAX_RECORD:
+            yield None, "Record too large"
+            return
+
+    if buffer.strip():
+        yield parse(buffer)
+
+
+async def read_array(text: AsyncIterator[str]) -> AsyncIterator[Parsed]:
+    """
+    Parses a JSON array one element at a time. Errors here are fatal, as
+    there is no way to find where the next element starts.
+    """
+
+    decoder = json.JSONDecoder()
+    buffer = ""
+    expected = "["
+
+    while True:
+        buffer = buffer.lstrip()
+
+        if not buffer:
+            chunk = await anext(text, None)
+            if chunk is None:
+                yield None, "Unexpected end of file"
+                return
+            buffer = chunk
+            continue
+
+        if expected == "[":
+            if buffer[0] != "[":
+                yield None, "Expected a JSON array"
+                return
+            buffer = buffer[1:]
+            expected = "first"
+        elif expected == ",":
+            if buffer[0] == "]":
+                return
+            if buffer[0] != ",":
+                yield None, "Expected , or ]"
+                return
+            buffer = buffer[1:]
+            expected = "value"
+        else:
+            if expected == "first" and buffer[0] == "]":
+                return
+
+            try:
+                record, end = decoder.raw_decode(buffer)
+            except json.JSONDecodeError as e:
+                # Most likely the element continues in the next chunk
+                chunk = await anext(text, None) \
+                    if len(buffer) <= MAX_RECORD else None
+                if chunk is not None:
+                    buffer += chunk
+                    continue
+                yield None, f"Invalid JSON: {e.msg}"
+                return
+
+            buffer = buffer[end:]
+            expected = ","
+            yield record, None
+
+
+async def read_records(file: UploadFile) -> AsyncIterator[Parsed]:
+    """
+    Reads NDJSON or a JSON array, told apart by the first character
+    """
+
+    text = read_text(file)
+    head = ""
+    async for chunk in text:
+        head += chunk
+        if head.strip():
+            break
+
+    async def replay() -> AsyncIterator[str]:
+        yield head
+        async for chunk in text:
+            yield chunk
+
+    reader = read_array if head.lstrip().startswith("[") else read_ndjson
+    async for parsed in reader(replay()):
+        yield parsed
+
+
+def describe(error: ValidationError) -> str:
+    return "; ".join(
+        f"{'.'.join(map(str, x['loc']))}: {x['msg']}" for x in error.errors()
+    )
+
+
+def is_usable_index(index: Any) -> bool:
+    return isinstance(index, (int, float)) and not isinstance(index, bool) \
+        and math.isfinite(index) and abs(index) < MAX_INDEX
+
+
+class Importer:
+    """
+    Buffers imported records and writes them in batches. Walls are always
+    written before the memos that might refer to them.
+    """
+
+    def __init__(
+        self, user_id: str, wall_ids: set[str],
+        users: Collection, walls: Collection, memos: Collection
+    ):
+        self.user_id = user_id
+        self.users = users
+        self.walls = walls
+        self.memos = memos
+        self.wall_ids = wall_ids
+        # Wall IDs in the file, mapped to the IDs of the created walls
+        self.imported_walls: dict[str, str] = {}
+        self.next_indexes: dict[str, float] = {}
+        self.pending_walls: list[Wall] = []
+        self.pending_memos: list[tuple[int, Memo]] = []
+        self.result = ImportResult()
+
+    def error(self, record: int, error: str) -> None:
+        if len(self.result.errors) < MAX_ERRORS:
+            self.result.errors.append(RecordError(record=record, error=error))
+
+    async def add(self, number: int, record: Any) -> None:
+        if not isinstance(record, dict) or \
+                not isinstance(record.get("data"), dict):
+            self.error(number, "Expected {\"type\": ..., \"data\": {...}}")
+        elif record.get("type") == "wall":
+            self.add_wall(number, record['data'])
+        elif record.get("type") == "memo":
+            await self.add_memo(number, record['data'])
+        else:
+            self.error(number, "Unknown record type")
+
+    def add_wall(self, number: int, data: dict) -> None:
+        try:
+            wall = PostWall.model_validate(data)
+        except ValidationError as e:
+            self.error(number, describe(e))
+            return
+
+        new_id = get_new_id(self.wall_ids)
+        self.wall_ids.add(new_id)
+        if isinstance(data.get("id"), str):
+            self.imported_walls[data['id']] = new_id
+
+        extra = {"created_at": wall.created_at} if "created_at" in data else {}
+        self.pending_walls.append(Wall(
+            **wall.model_dump(), **extra, id=new_id, user_id=self.user_id
+        ))
+
+    async def add_memo(self, number: int, data: dict) -> None:
+        try:
+            memo = PostMemo.model_validate(data)
+        except ValidationError as e:
+            self.error(number, describe(e))
+            return
+
+        source = data.get("wall_id")
+        if source in self.imported_walls:
+            wall_id = self.imported_walls[source]
+        elif source in self.wall_ids:
+            wall_id = source
+        else:
+            self.error(number, f"Unknown wall {source}")
+            return
+
+        index = data.get("index")
+        if source not in self.imported_walls or \
+                not is_usable_index(index):
+            # Records without a usable index go on top, in file order
+            if wall_id not in self.next_indexes:
+                self.next_indexes[wall_id] = await next_index(
+                    self.memos, self.user_id, wall_id
+                )
+            index = self.next_indexes[wall_id]
+            self.next_indexes[wall_id] += 1.0
+
+        extra = {"created_at": memo.created_at} if "created_at" in data else {}
+        self.pending_memos.append((number, Memo(
+            **memo.model_dump(), **extra,
+            id=get_new_id(token_len=12), user_id=self.user_id,
+            wall_id=wall_id, index=index
+        )))
+
+        if len(self.pending_memos) >= IMPORT_BATCH:
+            await self.flush()
+
+    async def flush(self) -> None:
+        if self.pending_walls:
+            await self.walls.insert_many(
+                [wall.model_dump() for wall in self.pending_walls]
+            )
+            await self.users.update_one(
+                {"id": self.user_id}, {"$inc": {"version": 1}}
+            )
+            self.result.walls += len(self.pending_walls)
+            self.pending_walls = []
+
+        if not self.pending_memos:
+            return
+
+        batch, self.pending_memos = self.pending_memos, []
+        failed = set()
+
+        size = sum(content_size(memo.content) for _, memo in batch)
+        if not await charge_usage(self.user_id, size):
+            for number, _ in batch:
+                self.error(number, "Storage quota exceeded")
+            return
+
+        try:
+            await self.memos.insert_many(
+                [memo.model_dump() for _, memo in batch], ordered=False
+            )
+        except BulkWriteError as e:
+            taken = []
+            refund = 0
+            for error in e.details['writeErrors']:
+                number, memo = batch[error['index']]
+                if error['code'] == 11000:
+                    taken.append(memo)
+                else:
+                    self.error(number, error['errmsg'])
+                    failed.add(error['index'])
+                    refund += content_size(memo.content)
+
+            for memo in taken:
+                memo.id = get_new_id(token_len=12)
+            await insert_memos(self.memos, taken)
+            await charge_usage(self.user_id, -refund)
+
+        written: dict[str, list[Memo]] = {}
+        for position, (_, memo) in enumerate(batch):
+            if position not in failed:
+                written.setdefault(memo.wall_id, []).append(memo)
+
+        for wall_id, wall_memos in written.items():
+            await bump_wall_version(
+                self.user_id, wall_id, len(wall_memos),
+                max(memo.modified_at for memo in wall_memos)
+            )
+
+        self.result.memos += len(batch) - len(failed)
+
+
+@router.post("")
+async def import_records(
+    login: Annotated[LoginInfo, Depends(user_depends(UserView))],
+    users: Annotated[Collection, Depends(collection_depends("users"))],
+    walls: Annotated[Collection, Depends(collection_depends("walls"))],
+    memos: Annotated[Collection, Depends(collection_depends("memos"))],
+    file: UploadFile
+) -> ImportResponse:
+    """
+    Imports a file in the export format, either NDJSON or a JSON array.
+    Walls get new IDs, and memos referring to them follow along.
+    """
+
+    wall_ids = set(await walls.distinct("id", {"user_id": login.user.id}))
+    importer = Importer(login.user.id, wall_ids, users, walls, memos)
+    number = 0
+
+    async for record, error in read_records(file):
+        number += 1
+        if error:
+            importer.error(number, error)
+        else:
+            await importer.add(number, record)
+
+    await importer.flush()
+
+    return ImportResponse(
+        data=importer.result,
+        meta=Meta(message="Import finished.")
+    )
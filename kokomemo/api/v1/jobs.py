@@ -0,0 +1,43 @@
+from kokomemo.dependencies.auth import LoginInfo, user_depends
+from kokomemo.api.v1.models import BaseResponse, Meta
+from kokomemo.jobs import get_job
+from kokomemo.models import Job, UserView
+from fastapi import APIRouter, Depends, HTTPException
+from pydantic import Field
+from pydantic.json_schema import SkipJsonSchema
+from datetime import datetime
+from typing import Annotated
+
+router = APIRouter()
+
+
+class JobNotFound(HTTPException):
+    def __init__(self):
+        super().__init__(status_code=404, detail="Job not found.")
+
+
+class ResponseJob(Job):
+    user_id: SkipJsonSchema[str] = Field(default="", exclude=True)
+    heartbeat_at: SkipJsonSchema[datetime] = Field(
+        default_factory=datetime.now, exclude=True
+    )
+
+
+class JobResponse(BaseResponse):
+    data: ResponseJob
+
+
+@router.get("/{job_id}")
+async def get_job_status(
+    job_id: str,
+    login: Annotated[LoginInfo, Depends(user_depends(UserView))]
+) -> JobResponse:
+    job = await get_job(login.user.id, job_id)
+
+    if not job:
+        raise JobNotFound()
+
+    return JobResponse(
+        data=ResponseJob(**job.model_dump()),
+        meta=Meta(message="Job successfully fetched.")
+    )
@@ -2,25 +2,32 @@ from kokomemo.config import Settings, get_config, config
 from kokomemo.db import collection_depends
 from kokomemo.auth import (
     get_new_id, get_user_ids, get_user,
-    new_session, get_new_tokens, verify_token
+    new_session, get_new_tokens, verify_token, invalidate_user,
+    evict_session_tokens
 )
-from kokomemo.models import User, Integration
+from kokomemo.models import User, UserView, Integration
 from kokomemo.logger import logger
-from kokomemo.dependencies.auth import InvalidToken, LoginInfo, check_user
+from kokomemo.google_auth import verify_google_token
+from kokomemo.dependencies.auth import InvalidToken, LoginInfo, user_depends
 from kokomemo.api.v1.models import BaseResponse, Meta
 from pydantic import BaseModel
-from fastapi import APIRouter, Body, Depends
+from fastapi import APIRouter, Body, Depends, HTTPException
 from motor.motor_asyncio import AsyncIOMotorCollection as Collection
 from pymongo import ReturnDocument
-from google.oauth2 import id_token
-from google.auth.transport import requests
+from requests import RequestException
 from typing import Annotated
 from datetime import datetime, timedelta, UTC
-import asyncio
 
 router = APIRouter()
 
 
+class GoogleUnavailable(HTTPException):
+    def __init__(self):
+        super().__init__(
+            status_code=503, detail="Couldn't fetch Google certificates."
+        )
+
+
 class LoginTokens(BaseModel):
     access_token: str
     refresh_token: str
@@ -37,11 +44,10 @@ async def get_google_idinfo(
     config: Annotated[Settings, Depends(get_config)]
 ) -> dict:
     try:
-        return await asyncio.get_running_loop().run_in_executor(
-            None, lambda: id_token.verify_oauth2_token(
-                token, requests.Request(), config.google_id
-            )
-        )
+        return await verify_google_token(token, config.google_id)
+    except RequestException:
+        logger.exception("Failed to fetch Google certs:")
+        raise GoogleUnavailable()
     except ValueError:
         logger.warning("validation failed: %s", token)
         raise InvalidToken()
@@ -105,12 +111,15 @@ async def google_login(
                         'service': 'google',
                         'data': {'id': idinfo['sub']}
                     }
-                }
+                },
+                "$inc": {"version": 1}
             },
             return_document=ReturnDocument.AFTER
         )
 
         user = User(**user_data) if user_data is not None else None
+        if user:
+            await invalidate_user(user.id)
 
     if not user:
         logger.debug(
@@ -143,15 +152,15 @@ async def google_login(
 
 @router.get("/logout")
 async def logout(
-    login: Annotated[LoginInfo, Depends(check_user)],
-    users: Annotated[Collection, Depends(
-        collection_depends("users")
+    login: Annotated[LoginInfo, Depends(user_depends(UserView))],
+    sessions: Annotated[Collection, Depends(
+        collection_depends("sessions")
     )]
 ) -> BaseResponse:
-    await users.update_one(
-        {"id": login.user.id},
-        {"$pull": {"sessions": {"id": login.token.sid}}}
+    await sessions.delete_one(
+        {"user_id": login.user.id, "id": login.token.sid}
     )
+    evict_session_tokens(login.token.sid)
 
     return BaseResponse(meta=Meta(message="Session has been deleted."))
 
@@ -159,12 +168,11 @@ async def logout(
 @router.post("/token/refresh")
 async def refresh(
     token: Annotated[str, Body(description="Refresh Token", embed=True)],
-    users: Annotated[Collection, Depends(collection_depends("users"))],
+    sessions: Annotated[Collection, Depends(collection_depends("sessions"))],
     config: Annotated[Settings, Depends(get_config)]
 ) -> LoginResponse:
     """
     This has to check:
-    If user exists
     If session exists
     If session is expired
     If the refresh id matches
@@ -183,44 +191,31 @@ async def refresh(
         raise InvalidToken()
 
     now = datetime.now(UTC)
+    new_id = get_new_id((body.rid,))
 
-    user = await get_user(body.sub)
-
-    if not user:
-        raise InvalidToken()
-
-    sessions = [
-        session for session in user.sessions if session.id == body.sid
-    ]
+    # All checks are part of the filter so a refresh token can only be
+    # redeemed once, even by concurrent requests
+    session = await sessions.find_one_and_update(
+        {
+            "user_id": body.sub,
+            "id": body.sid,
+            "current_refresh_id": body.rid,
+            "expires_at": {"$gt": now}
+        },
+        {"$set": {
+            "current_refresh_id": new_id,
+            "expires_at": now + timedelta(seconds=config.refresh_ttl)
+        }}
+    )
 
-    if not sessions:
+    if not session:
         logger.warning(
-            "Session %s for user %s not found: %s",
-            body.sid, body.sub, token
+            "Session %s for user %s not found, expired or already refreshed:"
+            " %s(%s)", body.sid, body.sub, token, body
         )
         raise InvalidToken()
 
-    session = sessions[0]
-
-    if session.current_refresh_id != body.rid:
-        logger.warning("Duplicated Refresh Token for %s: %s(%s)",
-                       body.sub, token, body)
-        raise InvalidToken()
-    
-    new_id = get_new_id((body.rid,))
-
-    await users.update_one(
-        {"id": body.sub},
-        {"$set": {
-            "sessions.$[session].current_refresh_id": new_id,
-            "sessions.$[session].expires_at": now + timedelta(
-                seconds=config.refresh_ttl
-            )
-        }},
-        array_filters=[{"session.id": body.sid}]
-    )
-
-    at, rt = get_new_tokens(user.id, body.sid, new_id)
+    at, rt = get_new_tokens(body.sub, body.sid, new_id)
 
     return LoginResponse(
         meta=Meta(message="Refresh Successful."),
@@ -1,16 +1,31 @@
-from kokomemo.dependencies.auth import LoginInfo, check_user
-from kokomemo.api.v1.models import BaseResponse, Meta
+from kokomemo.dependencies.auth import LoginInfo, user_depends
+from kokomemo.dependencies.etag import (
+    check_etag, make_etag, get_user_version, get_wall_version
+)
+from kokomemo.api.v1.models import BaseResponse, Meta, CursorMeta, envelope
+from kokomemo.api.v1.jobs import JobResponse, ResponseJob
 from kokomemo.auth import get_new_id
 from kokomemo.db import collection_depends
-from kokomemo.models import Wall, Memo
+from kokomemo.memos import (
+    insert_memo, insert_memos, insert_wall, wall_exists, next_index,
+    place_after,
+    rebalance_in_background, bump_wall_version, charge_usage, content_size,
+    REBALANCE_GAP
+)
+from kokomemo.config import config
+from kokomemo.jobs import create_job, discard_job, spawn
+from kokomemo.cursor import encode_cursor, decode_cursor
+from kokomemo.models import Wall, Memo, Tombstone, UserView
 from motor.motor_asyncio import AsyncIOMotorCollection as Collection
-from pymongo import ReturnDocument, DESCENDING
-from fastapi import APIRouter, Depends, HTTPException
+from pymongo import ReturnDocument, UpdateOne, ASCENDING, DESCENDING
+from fastapi import (
+    APIRouter, BackgroundTasks, Depends, HTTPException, Query,
+    Request, Response
+)
 from pydantic import BaseModel, Field
 from pydantic.json_schema import SkipJsonSchema
 from datetime import datetime, UTC
 from typing import Annotated
-from math import floor
 
 
 router = APIRouter()
@@ -21,13 +36,28 @@ class WallNotFound(HTTPException):
         super().__init__(status_code=404, detail="Wall not found.")
 
 
+class InvalidCursor(HTTPException):
+    def __init__(self):
+        super().__init__(status_code=400, detail="The cursor is invalid.")
+
+
 class MemoNotFound(HTTPException):
     def __init__(self):
         super().__init__(status_code=404, detail="Memo not found.")
 
 
+class QuotaExceeded(HTTPException):
+    def __init__(self):
+        super().__init__(status_code=413, detail="Storage quota exceeded.")
+
+
 class PostWall(Wall):
     id: SkipJsonSchema[str] = Field(default="", exclude=True)
+    user_id: SkipJsonSchema[str] = Field(default="", exclude=True)
+    memo_version: SkipJsonSchema[int] = Field(default=0, exclude=True)
+    memo_count: SkipJsonSchema[int] = Field(default=0, exclude=True)
+    last_memo_at: SkipJsonSchema[datetime | None] = \
+        Field(default=None, exclude=True)
     created_at: SkipJsonSchema[datetime] = Field(default=datetime.now(), exclude=True)
     modified_at: SkipJsonSchema[datetime] = Field(default=datetime.now(), exclude=True)
 
@@ -47,10 +77,28 @@ class PostMemo(Memo):
     modified_at: SkipJsonSchema[datetime] = Field(default=datetime.now(), exclude=True)
 
 
+class PostMemos(BaseModel):
+    memos: list[PostMemo] = Field(
+        min_length=1, max_length=config.memo_batch_limit
+    )
+
+
 class EditMemo(PostMemo):
     id: str
     content: str | None = None
-    after: int | None = None
+    # ID of the memo to place this one below, empty string for the top
+    after: str | None = None
+
+
+class MoveMemos(BaseModel):
+    ids: list[str] = Field(min_length=1, max_length=config.memo_batch_limit)
+    after: str
+
+
+class ResponseWall(Wall):
+    user_id: SkipJsonSchema[str] = Field(default="", exclude=True)
+    # Only there to build ETags from
+    memo_version: SkipJsonSchema[int] = Field(default=0, exclude=True)
 
 
 class ResponseMemo(Memo):
@@ -60,159 +108,284 @@ class ResponseMemo(Memo):
 
 
 class WallsResponse(BaseResponse):
-    data: list[Wall]
+    data: list[ResponseWall]
+    meta: CursorMeta
 
 
 class WallResponse(BaseResponse):
-    data: Wall
+    data: ResponseWall
 
 
 class MemosResponse(BaseResponse):
     data: list[ResponseMemo]
 
 
+class MemoPageResponse(MemosResponse):
+    meta: CursorMeta
+
+
 class MemoResponse(BaseResponse):
     data: ResponseMemo
 
 
-def is_valid_wallid(
+async def is_valid_wallid(
     wall_id,
-    login: Annotated[LoginInfo, Depends(check_user)]
+    login: Annotated[LoginInfo, Depends(user_depends(UserView))],
+    # Guards writes, so never from a secondary that may lag behind
+    walls: Annotated[Collection, Depends(collection_depends("walls"))]
 ):
-    if wall_id not in [wall.id for wall in login.user.walls]:
+    if not await wall_exists(walls, login.user.id, wall_id):
         raise WallNotFound()
 
     return wall_id
 
 
+async def bump_user_version(users: Collection, user_id: str) -> None:
+    """
+    Invalidates ETags of the wall list
+    """
+
+    await users.update_one({"id": user_id}, {"$inc": {"version": 1}})
+
+
 @router.get("")
-def get_walls(
-    login: Annotated[LoginInfo, Depends(check_user)]
+async def get_walls(
+    login: Annotated[LoginInfo, Depends(user_depends(UserView))],
+    walls: Annotated[
+        Collection, Depends(collection_depends("walls", read_only=True))
+    ],
+    request: Request,
+    response: Response,
+    after: str | None = None,
+    limit: Annotated[int, Query(ge=1, le=1000)] = 100
 ) -> WallsResponse:
-    walls = login.user.walls[::-1]
+    """
+    Walls from the newest, continuing from the `after` cursor returned in
+    meta by a previous page
+    """
 
-    return WallsResponse(
-        data=walls,
-        meta=Meta(message="List of walls successfully fetched.")
-    )
+    # Read before the walls, so the body is never older than its ETag
+    version = await get_user_version(login.user.id)
+
+    condition = {"user_id": login.user.id}
+    if after is not None:
+        try:
+            created_at, wall_id = decode_cursor(after, 2)
+            created_at = datetime.fromisoformat(created_at)
+        except (ValueError, TypeError):
+            raise InvalidCursor()
+        if not isinstance(wall_id, str):
+            raise InvalidCursor()
+
+        condition.update({"$or": [
+            {"created_at": {"$lt": created_at}},
+            {"created_at": created_at, "id": {"$lt": wall_id}}
+        ]})
+
+    page = [wall async for wall in walls.find(condition)
+                                        .sort([("created_at", DESCENDING),
+                                               ("id", DESCENDING)])
+                                        .limit(limit + 1)]
+
+    has_more = len(page) > limit
+    page = page[:limit]
+
+    # Memo counts change without the user's version, but every change
+    # comes with a new memo_version. So the page has to be read first, and
+    # a 304 here only saves serializing and sending it.
+    check_etag(request, response, make_etag(
+        "walls", login.user.id, version, after, limit,
+        *(f"{wall['id']}:{wall.get('memo_version', 0)}" for wall in page)
+    ))
+
+    meta = CursorMeta(message="List of walls successfully fetched.")
+    if has_more:
+        last = page[-1]
+        meta.next_cursor = encode_cursor(
+            last['created_at'].isoformat(), last['id']
+        )
+
+    return envelope(meta, ResponseWall, page, headers=response.headers)
 
 
 @router.post("")
 async def post_walls(
-    login: Annotated[LoginInfo, Depends(check_user)],
+    login: Annotated[LoginInfo, Depends(user_depends(UserView))],
     users: Annotated[Collection, Depends(collection_depends("users"))],
+    walls: Annotated[Collection, Depends(collection_depends("walls"))],
     data: PostWall
 ) -> WallResponse:
-    user = login.user
-    walls_id = [wall.id for wall in user.walls]
-
-    new_id = get_new_id(walls_id)
-
-    new_wall = Wall(**data.model_dump(), id=new_id)
-
-    await users.update_one(
-        {"id": login.user.id},
-        {"$push": {"walls": new_wall.model_dump()}}
+    new_wall = Wall(
+        **data.model_dump(), id=get_new_id(), user_id=login.user.id
     )
 
+    await insert_wall(walls, new_wall)
+    await bump_user_version(users, login.user.id)
+
     return WallResponse(
-        data=new_wall,
+        data=ResponseWall(**new_wall.model_dump()),
         meta=Meta(message="New wall has been successfully created.")
     )
 
 
 @router.put("")
 async def edit_walls(
-    login: Annotated[LoginInfo, Depends(check_user)],
+    login: Annotated[LoginInfo, Depends(user_depends(UserView))],
     users: Annotated[Collection, Depends(collection_depends("users"))],
+    walls: Annotated[Collection, Depends(collection_depends("walls"))],
     data: EditWall
 ) -> WallResponse:
-    if data.id not in [wall.id for wall in login.user.walls]:
-        raise WallNotFound()
-
-    payload = {"walls.$[wall].modified_at": datetime.now(UTC)}
+    payload = {"modified_at": datetime.now(UTC)}
     if data.name:
-        payload.update({"walls.$[wall].name": data.name})
+        payload.update({"name": data.name})
     if data.colour:
-        payload.update({"walls.$[wall].colour": data.colour})
+        payload.update({"colour": data.colour})
 
-    new_user = await users.find_one_and_update(
-        {"id": login.user.id},
+    wall = await walls.find_one_and_update(
+        {"user_id": login.user.id, "id": data.id},
         {"$set": payload},
-        array_filters=[{"wall.id": data.id}],
         return_document=ReturnDocument.AFTER
     )
 
-    wall = [wall for wall in new_user['walls'] if wall['id'] == data.id][0]
+    if not wall:
+        raise WallNotFound()
+
+    await bump_user_version(users, login.user.id)
 
     return WallResponse(
-        data=Wall(**wall),
+        data=ResponseWall(**wall),
         meta=Meta(message="Wall has been successfully edited.")
     )
 
 
 @router.delete("/{wall_id}")
 async def delete_walls(
-    wall_id: Annotated[str, Depends(is_valid_wallid)],
-    login: Annotated[LoginInfo, Depends(check_user)],
+    wall_id: str,
+    login: Annotated[LoginInfo, Depends(user_depends(UserView))],
     users: Annotated[Collection, Depends(collection_depends("users"))],
-) -> BaseResponse:
-    await users.update_one(
-        {"id": login.user.id},
-        {"$pull": {"walls": {"id": wall_id}}}
+    walls: Annotated[Collection, Depends(collection_depends("walls"))],
+    tombstones: Annotated[
+        Collection, Depends(collection_depends("tombstones"))
+    ]
+) -> JobResponse:
+    """
+    Removes the wall right away, its memos are deleted by the returned job
+    """
+
+    # Stored first, so the memos still get purged if we die right after
+    # the wall is gone
+    job = await create_job(
+        login.user.id, "purge_wall", start=False, wall_id=wall_id
     )
 
-    return BaseResponse(
+    result = await walls.delete_one({"user_id": login.user.id, "id": wall_id})
+
+    if not result.deleted_count:
+        await discard_job(job)
+        raise WallNotFound()
+
+    spawn(job.id)
+
+    await bump_user_version(users, login.user.id)
+    await tombstones.insert_one(Tombstone(
+        type="wall", id=wall_id, user_id=login.user.id
+    ).model_dump())
+
+    return JobResponse(
+        data=ResponseJob(**job.model_dump()),
         meta=Meta(message="The wall has been removed.")
     )
 
 
 @router.get("/{wall_id}/memos")
 async def get_memos(
-    wall_id: Annotated[str, Depends(is_valid_wallid)],
-    login: Annotated[LoginInfo, Depends(check_user)],
-    memos: Annotated[Collection, Depends(collection_depends("memos"))],
+    wall_id: str,
+    login: Annotated[LoginInfo, Depends(user_depends(UserView))],
+    memos: Annotated[
+        Collection, Depends(collection_depends("memos", read_only=True))
+    ],
+    request: Request,
+    response: Response,
     after: str | None = None,
-    limit: int = 20
-) -> MemosResponse:
-    if after:
-        after_memo = await memos.find_one({"id": after})
-        if not after_memo:
-            raise MemoNotFound()
-        index = after_memo['index']
+    before: str | None = None,
+    limit: Annotated[int, Query(ge=1, le=100)] = 20
+) -> MemoPageResponse:
+    """
+    Memos from the top of the wall, or around the `after`/`before` cursors
+    returned in meta by a previous page
+    """
+
+    if after is not None and before is not None:
+        raise HTTPException(
+            status_code=400, detail="Only one of after and before is allowed."
+        )
+
+    # Doubles as the check that the wall exists
+    version = await get_wall_version(login.user.id, wall_id)
+    if version is None:
+        raise WallNotFound()
 
-    condition = {"wall_id": wall_id, "user_id": login.user.id}
-    if after is not None:
-        condition.update({"index": {"$lt": index}})
-    memos = [ResponseMemo(**memo)
-             async for memo in memos.find(condition)
-                                    .sort("index", DESCENDING)
-                                    .limit(limit)]
+    check_etag(request, response, make_etag(
+        "memos", login.user.id, wall_id, version, after, before, limit
+    ))
+
+    backwards = before is not None
+    cursor = before if backwards else after
+    condition = {"user_id": login.user.id, "wall_id": wall_id}
+
+    if cursor is not None:
+        try:
+            index, memo_id = decode_cursor(cursor, 2)
+        except ValueError:
+            raise InvalidCursor()
+        # Anything else would end up in the query, operators included
+        if not isinstance(index, (int, float)) or isinstance(index, bool) \
+                or not isinstance(memo_id, str):
+            raise InvalidCursor()
+
+        # (index, id) tuple comparison, so memos sharing an index stay put
+        op = "$gt" if backwards else "$lt"
+        condition.update({"$or": [
+            {"index": {op: index}},
+            {"index": index, "id": {op: memo_id}}
+        ]})
+
+    order = ASCENDING if backwards else DESCENDING
+    page = [memo async for memo in memos.find(condition)
+                                        .sort([("index", order), ("id", order)])
+                                        .limit(limit + 1)]
+
+    has_more = len(page) > limit
+    page = page[:limit]
+    if backwards:
+        page.reverse()
+
+    meta = CursorMeta(message="Memos successfully fetched")
+    if page:
+        first = encode_cursor(page[0]['index'], page[0]['id'])
+        last = encode_cursor(page[-1]['index'], page[-1]['id'])
+        if backwards:
+            meta.next_cursor = last
+            meta.prev_cursor = first if has_more else None
+        else:
+            meta.next_cursor = last if has_more else None
+            meta.prev_cursor = first if after is not None else None
+    else:
+        meta.next_cursor = before
+        meta.prev_cursor = after
 
-    return MemosResponse(
-        data=memos,
-        meta=Meta(message="Memos successfully fetched")
-    )
+    return envelope(meta, ResponseMemo, page, headers=response.headers)
 
 
 @router.post("/{wall_id}/memos")
 async def post_memos(
     wall_id: Annotated[str, Depends(is_valid_wallid)],
-    login: Annotated[LoginInfo, Depends(check_user)],
+    login: Annotated[LoginInfo, Depends(user_depends(UserView))],
     memos: Annotated[Collection, Depends(collection_depends("memos"))],
     data: PostMemo
 ) -> MemoResponse:
-    memo_ids = [memo['id'] async for memo in memos.find({})]
-    new_id = get_new_id(memo_ids, 12)
-
-    recent_entry = [Memo(**x) async for x in memos.find({
-        "wall_id": wall_id,
-        "user_id": login.user.id
-    }).sort('index', DESCENDING).limit(1)]
-    if recent_entry:
-        index = floor(recent_entry[0].index) + 1.0
-    else:
-        index = 1.0
+    new_id = get_new_id(token_len=12)
+    index = await next_index(memos, login.user.id, wall_id)
 
     new_memo = Memo(
         **data.model_dump(),
@@ -220,7 +393,18 @@ async def post_memos(
         index=index
     )
 
-    await memos.insert_one(new_memo.model_dump())
+    size = content_size(new_memo.content)
+    if not await charge_usage(login.user.id, size):
+        raise QuotaExceeded()
+
+    try:
+        await insert_memo(memos, new_memo)
+    except Exception:
+        await charge_usage(login.user.id, -size)
+        raise
+    await bump_wall_version(
+        login.user.id, wall_id, 1, new_memo.modified_at
+    )
 
     return MemoResponse(
         data=ResponseMemo(**new_memo.model_dump()),
@@ -228,46 +412,184 @@ async def post_memos(
     )
 
 
+@router.post("/{wall_id}/memos/batch")
+async def post_memos_batch(
+    wall_id: Annotated[str, Depends(is_valid_wallid)],
+    login: Annotated[LoginInfo, Depends(user_depends(UserView))],
+    memos: Annotated[Collection, Depends(collection_depends("memos"))],
+    data: PostMemos
+) -> MemosResponse:
+    index = await next_index(memos, login.user.id, wall_id)
+
+    new_memos = [
+        Memo(
+            **memo.model_dump(),
+            id=get_new_id(token_len=12), user_id=login.user.id,
+            wall_id=wall_id, index=index + offset
+        )
+        for offset, memo in enumerate(data.memos)
+    ]
+
+    size = sum(content_size(memo.content) for memo in new_memos)
+    if not await charge_usage(login.user.id, size):
+        raise QuotaExceeded()
+
+    try:
+        await insert_memos(memos, new_memos)
+    except Exception:
+        await charge_usage(login.user.id, -size)
+        raise
+    await bump_wall_version(
+        login.user.id, wall_id, len(new_memos),
+        max(memo.modified_at for memo in new_memos)
+    )
+
+    return MemosResponse(
+        data=[ResponseMemo(**memo.model_dump()) for memo in new_memos],
+        meta=Meta(message="Memos successfully created.")
+    )
+
+
 @router.put("/{wall_id}/memos")
 async def edit_memo(
     wall_id: Annotated[str, Depends(is_valid_wallid)],
-    login: Annotated[LoginInfo, Depends(check_user)],
+    login: Annotated[LoginInfo, Depends(user_depends(UserView))],
     memos: Annotated[Collection, Depends(collection_depends("memos"))],
+    background: BackgroundTasks,
     data: EditMemo
 ):
     payload = {"modified_at": datetime.now(UTC)}
     if data.content:
         payload.update({"content": data.content})
+    if data.after is not None:
+        if data.after == data.id:
+            raise HTTPException(
+                status_code=400, detail="Can't place a memo after itself."
+            )
+
+        placement = await place_after(
+            memos, login.user.id, wall_id, data.after, [data.id]
+        )
+        if placement is None:
+            raise MemoNotFound()
 
-    memo = await memos.find_one_and_update(
-        {"id": data.id, "wall_id": wall_id, "user_id": login.user.id},
-        {"$set": payload},
-        return_document=ReturnDocument.AFTER
+        (index,), gap = placement
+        payload.update({"index": index})
+        if gap < REBALANCE_GAP:
+            background.add_task(
+                rebalance_in_background, memos, login.user.id, wall_id
+            )
+
+    condition = {"id": data.id, "wall_id": wall_id, "user_id": login.user.id}
+    before = await memos.find_one_and_update(
+        condition, {"$set": payload}, return_document=ReturnDocument.BEFORE
     )
 
-    if not memo:
+    if not before:
         raise MemoNotFound()
 
+    if "content" in payload:
+        # The old size is only known now, so take the edit back if the
+        # difference doesn't fit
+        size = content_size(payload['content']) - \
+            content_size(before.get('content', ""))
+        if not await charge_usage(login.user.id, size):
+            await memos.update_one(
+                {**condition, "content": payload['content']},
+                {"$set": {key: before[key] for key in payload}}
+            )
+            raise QuotaExceeded()
+
+    await bump_wall_version(
+        login.user.id, wall_id, modified_at=payload['modified_at']
+    )
+
     return MemoResponse(
-        data=ResponseMemo(**memo),
+        data=ResponseMemo(**{**before, **payload}),
         meta=Meta(message="Memo has been successfully edited.")
     )
 
 
+@router.put("/{wall_id}/memos/move")
+async def move_memos(
+    wall_id: Annotated[str, Depends(is_valid_wallid)],
+    login: Annotated[LoginInfo, Depends(user_depends(UserView))],
+    memos: Annotated[Collection, Depends(collection_depends("memos"))],
+    background: BackgroundTasks,
+    data: MoveMemos
+) -> MemosResponse:
+    if len(set(data.ids)) != len(data.ids) or data.after in data.ids:
+        raise HTTPException(
+            status_code=400, detail="Memos must be unique and not the target."
+        )
+
+    found = {
+        memo['id']: memo async for memo in memos.find({
+            "user_id": login.user.id, "wall_id": wall_id,
+            "id": {"$in": data.ids}
+        })
+    }
+    if len(found) != len(data.ids):
+        raise MemoNotFound()
+
+    placement = await place_after(
+        memos, login.user.id, wall_id, data.after, data.ids
+    )
+    if placement is None:
+        raise MemoNotFound()
+
+    indexes, gap = placement
+    now = datetime.now(UTC)
+
+    await memos.bulk_write([
+        UpdateOne(
+            {"user_id": login.user.id, "wall_id": wall_id, "id": memo_id},
+            {"$set": {"index": index, "modified_at": now}}
+        )
+        for memo_id, index in zip(data.ids, indexes)
+    ], ordered=False)
+    await bump_wall_version(login.user.id, wall_id, modified_at=now)
+
+    if gap < REBALANCE_GAP:
+        background.add_task(
+            rebalance_in_background, memos, login.user.id, wall_id
+        )
+
+    return MemosResponse(
+        data=[
+            ResponseMemo(**{
+                **found[memo_id], "index": index, "modified_at": now
+            })
+            for memo_id, index in zip(data.ids, indexes)
+        ],
+        meta=Meta(message="Memos successfully moved.")
+    )
+
+
 @router.delete("/{wall_id}/memos/{memo_id}")
 async def delete_memo(
     wall_id: Annotated[str, Depends(is_valid_wallid)],
     memo_id: str,
-    login: Annotated[LoginInfo, Depends(check_user)],
-    memos: Annotated[Collection, Depends(collection_depends("memos"))]
+    login: Annotated[LoginInfo, Depends(user_depends(UserView))],
+    memos: Annotated[Collection, Depends(collection_depends("memos"))],
+    tombstones: Annotated[
+        Collection, Depends(collection_depends("tombstones"))
+    ]
 ) -> BaseResponse:
-    result = await memos.delete_one(
-        {"id": memo_id, "wall_id": wall_id, "user_id": login.user.id}
+    memo = await memos.find_one_and_delete(
+        {"id": memo_id, "wall_id": wall_id, "user_id": login.user.id},
+        {"content": 1}
     )
 
-    if result.deleted_count != 1:
+    if not memo:
         raise MemoNotFound()
 
+    await charge_usage(login.user.id, -content_size(memo.get('content', "")))
+    await bump_wall_version(login.user.id, wall_id, -1)
+    await tombstones.insert_one(Tombstone(
+        type="memo", id=memo_id, user_id=login.user.id, wall_id=wall_id
+    ).model_dump())
+
     return BaseResponse(
         meta=Meta(message="Successfully deleted memo.")
     )
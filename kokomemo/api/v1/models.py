@@ -1,10 +1,71 @@
+from fastapi import Response
 from pydantic import BaseModel
+from pydantic.fields import FieldInfo
+from collections.abc import Iterable, Mapping
+from functools import cache
+from typing import Any
+import orjson
 
 
 class Meta(BaseModel):
     message: str
 
 
+class CursorMeta(Meta):
+    next_cursor: str | None = None
+    prev_cursor: str | None = None
+
+
 class BaseResponse(BaseModel):
     meta: Meta
     data: BaseModel | dict | None = None
+
+
+class RawJSONResponse(Response):
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_UTC_Z)
+
+
+@cache
+def dumped_fields(model: type[BaseModel]) -> tuple[tuple[str, FieldInfo], ...]:
+    return tuple(
+        (name, field) for name, field in model.model_fields.items()
+        if not field.exclude
+    )
+
+
+def dump_document(model: type[BaseModel], document: Mapping) -> dict:
+    """
+    What `model(**document).model_dump()` would give for a flat model,
+    without validating a document that already came from our database
+    """
+
+    return {
+        name: document[name] if name in document
+        else field.get_default(call_default_factory=True)
+        for name, field in dumped_fields(model)
+    }
+
+
+def envelope(
+    meta: Meta,
+    model: type[BaseModel],
+    data: Mapping | Iterable[Mapping],
+    headers: Mapping[str, str] | None = None
+) -> RawJSONResponse:
+    """
+    Serializes raw documents into the usual {"meta", "data"} response.
+    Returned responses skip FastAPI's response model, so routes keep their
+    return annotation for the schema only.
+    """
+
+    if isinstance(data, Mapping):
+        body = dump_document(model, data)
+    else:
+        body = [dump_document(model, document) for document in data]
+
+    return RawJSONResponse(
+        {"meta": meta.model_dump(), "data": body}, headers=headers
+    )
@@ -0,0 +1,157 @@
+from kokomemo.dependencies.auth import LoginInfo, user_depends
+from kokomemo.api.v1.models import BaseResponse, CursorMeta
+from kokomemo.api.v1.memo import ResponseMemo, WallNotFound, InvalidCursor
+from kokomemo.cursor import encode_cursor, decode_cursor
+from kokomemo.db import collection_depends
+from kokomemo.memos import wall_exists
+from kokomemo.models import UserView
+from motor.motor_asyncio import AsyncIOMotorCollection as Collection
+from fastapi import APIRouter, Depends, Query
+from pydantic import BaseModel
+from typing import Annotated
+import re
+
+router = APIRouter()
+
+# Results past this are not worth paging to, and skipping them gets slow
+MAX_RESULTS = 1000
+SNIPPET_LENGTH = 160
+ELLIPSIS = "…"
+
+TERM = re.compile(r'"([^"]+)"|(-?[^\s"]+)')
+
+
+class SearchResult(BaseModel):
+    memo: ResponseMemo
+    wall_id: str
+    score: float
+    snippet: str
+    # [start, end) offsets of the matched words in snippet
+    highlights: list[tuple[int, int]]
+
+
+class SearchResponse(BaseResponse):
+    data: list[SearchResult]
+    meta: CursorMeta
+
+
+def highlight_pattern(query: str) -> re.Pattern | None:
+    """
+    Approximates what the text index matched. The index stems words, so
+    a term also matches any word it starts.
+    """
+
+    parts = []
+    for phrase, word in TERM.findall(query):
+        if phrase:
+            parts.append(re.escape(phrase))
+        elif not word.startswith("-"):
+            parts.append(rf"\b{re.escape(word)}\w*")
+
+    if not parts:
+        return None
+
+    # Longest first, so a phrase wins over the words inside it
+    parts.sort(key=len, reverse=True)
+    return re.compile("|".join(parts), re.IGNORECASE)
+
+
+def make_snippet(
+    content: str, pattern: re.Pattern | None
+) -> tuple[str, list[tuple[int, int]]]:
+    matches = list(pattern.finditer(content)) if pattern else []
+
+    start = 0
+    if matches and len(content) > SNIPPET_LENGTH:
+        # Centre the window on the first match, then back off to a space
+        start = max(0, matches[0].start() - SNIPPET_LENGTH // 3)
+        start = min(start, len(content) - SNIPPET_LENGTH)
+        space = content.rfind(" ", 0, start + 1)
+        if space != -1 and start - space < 20:
+            start = space + 1
+    end = min(len(content), start + SNIPPET_LENGTH)
+
+    prefix = ELLIPSIS if start > 0 else ""
+    suffix = ELLIPSIS if end < len(content) else ""
+    snippet = prefix + content[start:end] + suffix
+
+    shift = len(prefix) - start
+    highlights = [
+        (max(match.start(), start) + shift, min(match.end(), end) + shift)
+        for match in matches
+        if match.end() > start and match.start() < end
+    ]
+
+    return snippet, highlights
+
+
+@router.get("")
+async def search_memos(
+    login: Annotated[LoginInfo, Depends(user_depends(UserView))],
+    walls: Annotated[
+        Collection, Depends(collection_depends("walls", read_only=True))
+    ],
+    memos: Annotated[
+        Collection, Depends(collection_depends("memos", read_only=True))
+    ],
+    q: Annotated[str, Query(min_length=1, max_length=256)],
+    wall_id: str | None = None,
+    cursor: str | None = None,
+    limit: Annotated[int, Query(ge=1, le=100)] = 20
+) -> SearchResponse:
+    """
+    Memos matching `q` across every wall, or only `wall_id`, best match
+    first. Supports "quoted phrases" and -excluded words. `cursor` takes
+    `next_cursor` from the previous page's meta.
+    """
+
+    if wall_id is not None and \
+            not await wall_exists(walls, login.user.id, wall_id):
+        raise WallNotFound()
+
+    offset = 0
+    if cursor is not None:
+        try:
+            offset, = decode_cursor(cursor, 1)
+        except ValueError:
+            raise InvalidCursor()
+        if not isinstance(offset, int) or not 0 <= offset < MAX_RESULTS:
+            raise InvalidCursor()
+
+    # The text index is prefixed by user_id, so this only ever scans
+    # the user's own memos
+    condition = {"user_id": login.user.id, "$text": {"$search": q}}
+    if wall_id is not None:
+        condition['wall_id'] = wall_id
+
+    score = {"score": {"$meta": "textScore"}}
+    count = min(limit, MAX_RESULTS - offset)
+    page = [memo async for memo in memos.find(condition, score)
+                                        .sort([("score", score['score'])])
+                                        .skip(offset)
+                                        .limit(count + 1)]
+
+    has_more = len(page) > count and offset + count < MAX_RESULTS
+    page = page[:count]
+
+    pattern = highlight_pattern(q)
+    results = []
+    for memo in page:
+        snippet, highlights = make_snippet(memo['content'], pattern)
+        results.append(SearchResult(
+            memo=ResponseMemo(**memo),
+            wall_id=memo['wall_id'],
+            score=memo['score'],
+            snippet=snippet,
+            highlights=highlights
+        ))
+
+    return SearchResponse(
+        data=results,
+        meta=CursorMeta(
+            message="Search results successfully fetched",
+            next_cursor=encode_cursor(offset + count) if has_more else None,
+            prev_cursor=encode_cursor(max(0, offset - limit))
+            if offset else None
+        )
+    )
@@ -0,0 +1,175 @@
+from kokomemo.dependencies.auth import LoginInfo, user_depends
+from kokomemo.api.v1.models import (
+    BaseResponse, Meta, RawJSONResponse, dump_document
+)
+from kokomemo.api.v1.export import ExportWall, ExportMemo
+from kokomemo.config import Settings, get_config
+from kokomemo.cursor import encode_cursor, decode_cursor
+from kokomemo.db import collection_depends
+from kokomemo.models import Tombstone, UserView
+from motor.motor_asyncio import AsyncIOMotorCollection as Collection
+from pymongo import ASCENDING
+from fastapi import APIRouter, Depends, HTTPException, Query
+from pydantic import BaseModel, Field
+from pydantic.json_schema import SkipJsonSchema
+from datetime import datetime, timedelta, UTC
+from typing import Annotated
+
+router = APIRouter()
+
+EPOCH = datetime(1970, 1, 1, tzinfo=UTC)
+# Writes stamped just before a sync can land just after it. Every sync
+# starts this far back, so clients may see a change twice but never miss it.
+SYNC_SKEW = timedelta(seconds=5)
+
+
+class InvalidSyncToken(HTTPException):
+    def __init__(self):
+        super().__init__(status_code=400, detail="The sync token is invalid.")
+
+
+class SyncExpired(HTTPException):
+    def __init__(self):
+        super().__init__(
+            status_code=410,
+            detail="The sync token is too old, sync again without it."
+        )
+
+
+class SyncWall(ExportWall):
+    # Memo writes change these without touching modified_at, so a client
+    # would never see them change. It has the memos to work them out.
+    memo_version: SkipJsonSchema[int] = Field(default=0, exclude=True)
+    memo_count: SkipJsonSchema[int] = Field(default=0, exclude=True)
+    last_memo_at: SkipJsonSchema[datetime | None] = \
+        Field(default=None, exclude=True)
+
+
+class ResponseTombstone(Tombstone):
+    user_id: SkipJsonSchema[str] = Field(default="", exclude=True)
+
+
+class SyncData(BaseModel):
+    walls: list[SyncWall]
+    memos: list[ExportMemo]
+    tombstones: list[ResponseTombstone]
+    # Pass to the next call. If has_more is set, call again right away.
+    sync_token: str
+    has_more: bool
+
+
+class SyncResponse(BaseResponse):
+    data: SyncData
+
+
+def to_ms(time: datetime) -> int:
+    return (time - EPOCH) // timedelta(milliseconds=1)
+
+
+def from_ms(ms: int) -> datetime:
+    return EPOCH + timedelta(milliseconds=ms)
+
+
+def is_ms(value) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+@router.get("")
+async def sync(
+    login: Annotated[LoginInfo, Depends(user_depends(UserView))],
+    walls: Annotated[Collection, Depends(collection_depends("walls"))],
+    memos: Annotated[Collection, Depends(collection_depends("memos"))],
+    tombstones: Annotated[
+        Collection, Depends(collection_depends("tombstones"))
+    ],
+    config: Annotated[Settings, Depends(get_config)],
+    since: str | None = None,
+    limit: Annotated[int, Query(ge=1, le=1000)] = 500
+) -> SyncResponse:
+    """
+    Walls, memos and deletions since the token from the previous sync,
+    or everything without one. Memos are paged by `limit`, walls and
+    tombstones come with the first page.
+    """
+
+    now = datetime.now(UTC)
+
+    # [since, start of this sync, last memo modified_at, last memo id]
+    # Either only since is set, or all four are for a following page
+    try:
+        since_ms, started_ms, after_ms, after_id = \
+            decode_cursor(since, 4) if since else (0, None, None, None)
+        first_page = after_ms is None
+
+        if not is_ms(since_ms):
+            raise ValueError
+        if first_page and (started_ms, after_id) != (None, None):
+            raise ValueError
+        if not first_page and not (
+            is_ms(started_ms) and is_ms(after_ms) and isinstance(after_id, str)
+        ):
+            raise ValueError
+
+        since_time = from_ms(since_ms)
+        if not first_page:
+            after_time = from_ms(after_ms)
+            # Where the sync after this one starts
+            next_since = from_ms(started_ms) - SYNC_SKEW
+    except (ValueError, TypeError, OverflowError):
+        raise InvalidSyncToken()
+
+    if first_page:
+        started_ms = to_ms(now)
+        next_since = from_ms(started_ms) - SYNC_SKEW
+        if since_ms and now - since_time > timedelta(
+            seconds=config.tombstone_ttl
+        ):
+            raise SyncExpired()
+
+    condition = {"user_id": login.user.id, "modified_at": {"$gte": since_time}}
+    if not first_page:
+        condition.update({"$or": [
+            {"modified_at": {"$gt": after_time}},
+            {"modified_at": after_time, "id": {"$gt": after_id}}
+        ]})
+
+    page = [memo async for memo in memos.find(condition)
+                                        .sort([("modified_at", ASCENDING),
+                                               ("id", ASCENDING)])
+                                        .limit(limit + 1)]
+    has_more = len(page) > limit
+    page = page[:limit]
+
+    changed, deleted = [], []
+    if first_page:
+        changed = [dump_document(SyncWall, wall)
+                   async for wall in walls.find({
+                       "user_id": login.user.id,
+                       "modified_at": {"$gte": since_time}
+                   })]
+        deleted = [dump_document(ResponseTombstone, tombstone)
+                   async for tombstone in tombstones.find({
+                       "user_id": login.user.id,
+                       "deleted_at": {"$gte": since_time}
+                   })]
+
+    if has_more:
+        last = page[-1]
+        token = encode_cursor(
+            since_ms, started_ms, to_ms(last['modified_at']), last['id']
+        )
+    else:
+        token = encode_cursor(
+            to_ms(next_since), None, None, None
+        )
+
+    return RawJSONResponse({
+        "meta": Meta(message="Changes successfully fetched.").model_dump(),
+        "data": {
+            "walls": changed,
+            "memos": [dump_document(ExportMemo, memo) for memo in page],
+            "tombstones": deleted,
+            "sync_token": token,
+            "has_more": has_more
+        }
+    })
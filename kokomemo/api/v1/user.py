@@ -1,13 +1,15 @@
 from .login import router as login
-from kokomemo.db import collection_depends
-from kokomemo.dependencies.auth import check_user, LoginInfo
-from kokomemo.models import User, Session, Wall, Integration
+from kokomemo.db import collection_depends, projection_of
+from kokomemo.auth import invalidate_user
+from kokomemo.dependencies.auth import user_depends, LoginInfo
+from kokomemo.dependencies.etag import check_etag, make_etag
+from kokomemo.models import UserView
 from .models import BaseResponse, Meta
 from kokomemo.logger import logger
 from motor.motor_asyncio import AsyncIOMotorCollection as Collection
-from fastapi import APIRouter, Depends
-from pydantic import BaseModel, Field
-from pydantic.json_schema import SkipJsonSchema
+from fastapi import APIRouter, Depends, Request, Response
+from pydantic import BaseModel
+from datetime import datetime
 from typing import Annotated
 
 router = APIRouter()
@@ -19,13 +21,15 @@ router.include_router(
 )
 
 
-class PartialIntegration(Integration):
-    data: SkipJsonSchema[dict] = Field(default=[], exclude=True)
+class PartialIntegration(BaseModel):
+    service: str
 
 
-class UserInfo(User):
-    sessions: SkipJsonSchema[list[Session]] = Field(default=[], exclude=True)
-    walls: SkipJsonSchema[list[Wall]] = Field(default=[], exclude=True)
+class UserInfo(UserView):
+    name: str
+    email: str
+    used_bytes: int = 0
+    created_at: datetime
     integrations: list[PartialIntegration]
 
 
@@ -38,29 +42,43 @@ class UserInfoRequest(BaseModel):
 
 
 @router.get("/info")
-def get_userinfo(
-    user: Annotated[LoginInfo, Depends(check_user)]
+async def get_userinfo(
+    user: Annotated[LoginInfo, Depends(user_depends(UserView))],
+    users: Annotated[
+        Collection, Depends(collection_depends("users", read_only=True))
+    ],
+    request: Request,
+    response: Response
 ) -> UserInfoResponse:
-    user_info = UserInfo(**user.user.model_dump())
+    # One read for both the tag and the body, which is small enough that
+    # a 304 is only about not sending it
+    info = await users.find_one(
+        {"id": user.user.id}, {**projection_of(UserInfo), "version": 1}
+    )
+    # Memo writes change used_bytes without bumping the version
+    check_etag(request, response, make_etag(
+        "info", user.user.id, info.get('version', 0), info.get('used_bytes', 0)
+    ))
 
     return UserInfoResponse(
         meta=Meta(message="User successfully queried"),
-        data=user_info
+        data=UserInfo(**info)
     )
 
 
 @router.put("/info")
 async def put_userinfo(
-    user: Annotated[LoginInfo, Depends(check_user)],
+    user: Annotated[LoginInfo, Depends(user_depends(UserInfo))],
     users: Annotated[Collection, Depends(collection_depends("users"))],
     user_info: UserInfoRequest
 ) -> UserInfoResponse:
     await users.update_one(
-        {"id": user.user.id}, {"$set": {"name": user_info.name}}
+        {"id": user.user.id},
+        {"$set": {"name": user_info.name}, "$inc": {"version": 1}}
     )
-    user.user.name = user_info.name
+    await invalidate_user(user.user.id)
 
     return UserInfoResponse(
         meta=Meta(message="Info successfully updated."),
-        data=UserInfo(**user.user.model_dump())
+        data=user.user.model_copy(update={"name": user_info.name})
     )
@@ -1,13 +1,34 @@
-from .db import get_collection
+from .db import get_collection, projection_of
+from .cache import TTLCache
 from .config import config
-from .models import User, Session, Token
+from .models import User, UserView, Session, Token
 from .logger import logger
-from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, PyMongoError
 import jwt
 from jwt.exceptions import InvalidTokenError
-from collections.abc import Sequence
+from collections.abc import Awaitable, Callable, Sequence
 from secrets import token_urlsafe
+from hashlib import sha256
 from datetime import datetime, timedelta, UTC
+from typing import TypeVar
+import asyncio
+
+V = TypeVar("V", User, UserView)
+
+# Every entry maps the view models loaded so far to their instance
+user_cache: TTLCache[str, dict[type, User | UserView]] = TTLCache(
+    config.user_cache_size, config.user_cache_ttl
+)
+
+# Called with the user ID after every local invalidation, e.g. to publish it
+# to other workers. Workers receiving such a message should only call
+# `user_cache.pop`, not `invalidate_user`, to avoid echoing it back.
+invalidation_hooks: list[Callable[[str], Awaitable[None]]] = []
+
+# Verified access tokens keyed by their digest, each kept until its exp
+token_cache: TTLCache[bytes, Token] = TTLCache(
+    config.token_cache_size, config.access_ttl
+)
 
 
 def verify_token(token: str) -> Token | None:
@@ -15,8 +36,12 @@ def verify_token(token: str) -> Token | None:
     Checks jwt validity and exp
     """
 
+    key = sha256(token.encode()).digest()
+    cached = token_cache.get(key)
+    if cached is not None:
+        return cached
+
     try:
-        logger.debug("testing %s", token)
         data = jwt.decode(
             token, config.secret, algorithms=["HS256"],
             options={
@@ -31,6 +56,9 @@ def verify_token(token: str) -> Token | None:
 
     if data.typ == "AT":
         logger.debug("AT detected")
+        token_cache.set(
+            key, data, (data.exp - datetime.now(UTC)).total_seconds()
+        )
         return data
     elif data.typ == "RT":
         logger.debug("RT detected")
@@ -44,6 +72,14 @@ def verify_token(token: str) -> Token | None:
     return data
 
 
+def evict_session_tokens(session_id: str) -> int:
+    """
+    Drops cached access tokens of a revoked session
+    """
+
+    return token_cache.pop_where(lambda token: token.sid == session_id)
+
+
 def get_new_tokens(user_id: str, session_id: str, refresh_id: str, now=None,
                    ttl: int = config.refresh_ttl) -> tuple[str, str]:
     if now is None:
@@ -75,39 +111,35 @@ def get_new_tokens(user_id: str, session_id: str, refresh_id: str, now=None,
 async def new_session(user: User, ttl: int = config.refresh_ttl) \
                 -> tuple[str, tuple[str, str]]:
     now = datetime.now(UTC)
-    session_ids = [session.id for session in user.sessions]
-    new_id = get_new_id(session_ids)
     new_refresh_id = get_new_id()
     session = Session(
-        id=new_id,
+        id=get_new_id(),
+        user_id=user.id,
         current_refresh_id=new_refresh_id,
         created_at=now,
         expires_at=now + timedelta(seconds=ttl)
     )
 
-    await get_collection("users").update_one(
-        {"id": user.id},
-        {"$push": {"sessions": session.model_dump()}}
-    )
+    while True:
+        try:
+            await get_collection("sessions").insert_one(session.model_dump())
+            break
+        except DuplicateKeyError:
+            session.id = get_new_id()
 
-    return (new_id, get_new_tokens(user.id, new_id, new_refresh_id, now, ttl))
+    return (
+        session.id,
+        get_new_tokens(user.id, session.id, new_refresh_id, now, ttl)
+    )
 
 
 async def get_user(query: str | dict) -> User | None:
-    """
-    Queries user while wiping out expired sessions
-    """
-
     if isinstance(query, str):
         query = {"id": query}
     elif not isinstance(query, dict):
         raise ValueError("query should be str or dict")
 
-    user = await get_collection("users").find_one_and_update(
-        query,
-        {"$pull": {"sessions": {"expires_at": {"$lte": datetime.now(UTC)}}}},
-        return_document=ReturnDocument.AFTER
-    )
+    user = await get_collection("users").find_one(query)
 
     if not user:
         return None
@@ -115,11 +147,72 @@ async def get_user(query: str | dict) -> User | None:
     return User(**user)
 
 
+async def get_cached_user(user_id: str, view: type[V] = User) -> V | None:
+    """
+    Reads user from the cache, falling back to a query that only fetches
+    the fields declared on the view
+    """
+
+    views = user_cache.get(user_id)
+    if views is not None and view in views:
+        return views[view]
+
+    data = await get_collection("users").find_one(
+        {"id": user_id}, projection_of(view)
+    )
+    if not data:
+        return None
+
+    user = view(**data)
+
+    if views is None:
+        views = {}
+        user_cache.set(user_id, views)
+    views[view] = user
+
+    return user
+
+
+async def invalidate_user(user_id: str) -> None:
+    user_cache.pop(user_id)
+
+    for hook in invalidation_hooks:
+        await hook(user_id)
+
+
+async def watch_users(retry_interval: float = 5) -> None:
+    """
+    Evicts users changed by any worker using a change stream.
+    Requires MongoDB to run as a replica set.
+    """
+
+    pipeline = [{"$project": {"operationType": 1, "fullDocument.id": 1}}]
+
+    while True:
+        try:
+            async with get_collection("users").watch(
+                pipeline, full_document="updateLookup"
+            ) as stream:
+                # Anything could have changed while we weren't listening
+                user_cache.clear()
+                async for change in stream:
+                    document = change.get("fullDocument")
+                    if document:
+                        user_cache.pop(document['id'])
+                    else:
+                        user_cache.clear()
+        except PyMongoError:
+            logger.exception("User change stream failed:")
+            user_cache.clear()
+            await asyncio.sleep(retry_interval)
+
+
 async def get_session_ids(user_id: str) -> list[str]:
-    user = await get_user(user_id)
-    if user is None:
-        raise RuntimeError("user %s not found", user_id)
-    return [session.id for session in user.sessions]
+    cursor = get_collection("sessions").find(
+        {"user_id": user_id, "expires_at": {"$gt": datetime.now(UTC)}},
+        {"id": 1}
+    )
+    return [x['id'] async for x in cursor]
 
 
 async def get_user_ids() -> list[str]:
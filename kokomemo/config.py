@@ -1,4 +1,10 @@
 from pydantic_settings import BaseSettings, SettingsConfigDict
+from typing import Literal
+
+ReadPreferenceName = Literal[
+    "primary", "primaryPreferred", "secondary", "secondaryPreferred", "nearest"
+]
+ReadConcernLevel = Literal["local", "available", "majority"]
 
 
 class Settings(BaseSettings):
@@ -6,15 +12,62 @@ class Settings(BaseSettings):
     app_name: str = "kokomemo"
     mongodb_url: str = "mongodb://localhost:27017"
     dbname: str = app_name
+    # Connection pool and timeouts, see the pymongo MongoClient options
+    mongodb_max_pool_size: int = 100
+    mongodb_min_pool_size: int = 0
+    mongodb_max_idle_time_ms: int | None = None
+    mongodb_server_selection_timeout_ms: int = 30000
+    mongodb_connect_timeout_ms: int = 20000
+    mongodb_socket_timeout_ms: int | None = None
+    # Wire compression in order of preference, like "zstd,snappy,zlib".
+    # zstd and snappy need the pymongo[zstd] and pymongo[snappy] extras.
+    mongodb_compressors: str | None = None
+    # Where read-only routes such as GET /walls read from. ETags and
+    # bodies then come from secondaries, and may trail recent writes.
+    mongodb_read_preference: ReadPreferenceName = "primary"
+    mongodb_read_concern: ReadConcernLevel | None = None
+    # Create missing indexes on startup, see `python -m kokomemo indexes`
+    auto_index: bool = True
     logfile: str | None = None
+    # Rotate the logfile at this size, keeping this many old ones
+    logfile_max_bytes: int = 10 * 1024 * 1024
+    logfile_backups: int = 5
     loglevel: str = "INFO"
+    # One JSON object per line, with the request ID of each record
+    log_json: bool = False
+    # One line per request, for this fraction of requests
+    access_log: bool = True
+    access_log_sample_rate: float = 1.0
+    # Serve Prometheus metrics on /metrics
+    metrics: bool = True
     # Secret key for JWT signing- I recommend 256bit or larger!
     secret: str | None = None
     google_id: str | None = None
+    google_certs_url: str = "https://www.googleapis.com/oauth2/v1/certs"
+    # Threads verifying Google ID tokens
+    google_verify_workers: int = 4
     # Access Token TTL: 30 minutes
     access_ttl: int = 1800
     # Refresh Token TTL: 1 week
     refresh_ttl: int = 604800
+    # Authenticated users cached per worker, and for how many seconds
+    user_cache_size: int = 4096
+    user_cache_ttl: float = 30
+    # Evict users changed by other workers through a change stream
+    user_cache_watch: bool = False
+    # Bytes of memo content a user may store, unlimited if unset.
+    # Check the totals with `python -m kokomemo repair-usage` first.
+    user_quota_bytes: int | None = None
+    # Most memos accepted by a single batch request
+    memo_batch_limit: int = 100
+    # How long deletions are remembered for delta sync: 30 days.
+    # Changing it requires a collMod on the tombstones TTL index.
+    tombstone_ttl: int = 2592000
+    # How long finished jobs can still be looked up: 1 week.
+    # Changing it requires a collMod on the jobs TTL index.
+    job_ttl: int = 604800
+    # Verified access tokens cached per worker
+    token_cache_size: int = 16384
 
     model_config = SettingsConfigDict(env_file=".env")
 
@@ -0,0 +1,29 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as DecodeError
+import json
+
+
+def encode_cursor(*values) -> str:
+    """
+    Packs JSON-serializable values into an opaque URL-safe token
+    """
+
+    data = json.dumps(values, separators=(",", ":")).encode()
+    return urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, length: int) -> list:
+    """
+    Reverses `encode_cursor`, raising ValueError on anything malformed
+    """
+
+    try:
+        data = urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(data)
+    except (DecodeError, UnicodeDecodeError, json.JSONDecodeError):
+        raise ValueError("malformed cursor")
+
+    if not isinstance(values, list) or len(values) != length:
+        raise ValueError("malformed cursor")
+
+    return values
@@ -1,14 +1,45 @@
 from .config import config
 from .logger import logger
+from .metrics import CommandMetrics, PoolMetrics, mongo_checked_out
 from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorCollection
 from bson.codec_options import CodecOptions
-from typing import Callable
+from pymongo.read_concern import ReadConcern
+from pymongo.read_preferences import ReadPreference
+from pydantic import BaseModel
+from functools import cache
+from time import perf_counter
+from typing import Callable, get_args, get_origin
+import asyncio
 
 client = None
 db = None
 
 options: CodecOptions = CodecOptions(tz_aware=True)
 
+READ_PREFERENCES = {
+    "primary": ReadPreference.PRIMARY,
+    "primaryPreferred": ReadPreference.PRIMARY_PREFERRED,
+    "secondary": ReadPreference.SECONDARY,
+    "secondaryPreferred": ReadPreference.SECONDARY_PREFERRED,
+    "nearest": ReadPreference.NEAREST
+}
+
+
+def client_options() -> dict:
+    kwargs = {
+        "maxPoolSize": config.mongodb_max_pool_size,
+        "minPoolSize": config.mongodb_min_pool_size,
+        "maxIdleTimeMS": config.mongodb_max_idle_time_ms,
+        "serverSelectionTimeoutMS":
+            config.mongodb_server_selection_timeout_ms,
+        "connectTimeoutMS": config.mongodb_connect_timeout_ms,
+        "socketTimeoutMS": config.mongodb_socket_timeout_ms
+    }
+    if config.mongodb_compressors:
+        kwargs['compressors'] = config.mongodb_compressors
+
+    return kwargs
+
 
 async def db_connect(url: str | None = None) -> None:
     global client, db
@@ -22,22 +53,96 @@ async def db_connect(url: str | None = None) -> None:
 
     logger.debug("Attempting to connect to %s", url)
 
-    client = AsyncIOMotorClient(url)
+    # The pool listener also feeds the saturation reported by /health
+    listeners = [CommandMetrics(), PoolMetrics()] if config.metrics \
+        else [PoolMetrics()]
+    client = AsyncIOMotorClient(
+        url, event_listeners=listeners, **client_options()
+    )
     db = client[config.dbname]
 
-    await db.command("ping")
+    # Open minPoolSize connections now rather than on the first requests
+    await asyncio.gather(*[
+        db.command("ping")
+        for _ in range(max(1, config.mongodb_min_pool_size))
+    ])
 
     logger.debug("MongoDB connected!")
 
 
-def get_collection(name: str) -> AsyncIOMotorCollection:
+def close_db() -> None:
+    global client, db
+
+    if client is not None:
+        client.close()
+    client = db = None
+
+
+def get_collection(
+    name: str, read_only: bool = False
+) -> AsyncIOMotorCollection:
+    """
+    `read_only` collections follow the configured read preference and read
+    concern, so only use them where slightly stale data is fine
+    """
+
     if db is None:
         raise RuntimeError("DB is not initialized!")
-    return db[name].with_options(options)
 
+    if not read_only:
+        return db[name].with_options(options)
+
+    concern = config.mongodb_read_concern
+    return db[name].with_options(
+        options,
+        read_preference=READ_PREFERENCES[config.mongodb_read_preference],
+        read_concern=ReadConcern(concern) if concern else None
+    )
 
-def collection_depends(name: str) -> Callable[[], AsyncIOMotorCollection]:
+
+def collection_depends(
+    name: str, read_only: bool = False
+) -> Callable[[], AsyncIOMotorCollection]:
     def inner_depends() -> AsyncIOMotorCollection:
-        return get_collection(name)
+        return get_collection(name, read_only)
 
     return inner_depends
+
+
+async def health() -> dict:
+    start = perf_counter()
+    await db.command("ping")
+    latency = perf_counter() - start
+
+    in_use = mongo_checked_out.values.get((), 0)
+    return {
+        "ping_ms": round(latency * 1000, 3),
+        "pool": {
+            "in_use": in_use,
+            "max_size": config.mongodb_max_pool_size,
+            "saturation": round(in_use / config.mongodb_max_pool_size, 3)
+            if config.mongodb_max_pool_size else None
+        }
+    }
+
+
+@cache
+def projection_of(model: type[BaseModel], prefix: str = "") -> dict[str, int]:
+    """
+    Builds a projection that only fetches the fields declared on the model,
+    descending into nested models and lists of them
+    """
+
+    projection = {}
+
+    for name, field in model.model_fields.items():
+        annotation = field.annotation
+        if get_origin(annotation) is list:
+            annotation = get_args(annotation)[0]
+
+        if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+            projection.update(projection_of(annotation, f"{prefix}{name}."))
+        else:
+            projection[prefix + name] = 1
+
+    return projection
@@ -1,12 +1,11 @@
-from kokomemo.models import User, Token
-from kokomemo.db import collection_depends
-from kokomemo.auth import verify_token, get_user
+from kokomemo.models import User, UserView, Token
+from kokomemo.auth import verify_token, get_cached_user
 from kokomemo.logger import logger
-from motor.motor_asyncio import AsyncIOMotorCollection as Collection
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from fastapi import HTTPException, Depends
 from pydantic import BaseModel
-from typing import Annotated
+from functools import cache
+from typing import Annotated, Callable, Awaitable
 
 security = HTTPBearer(
     scheme_name="Access Token",
@@ -20,7 +19,7 @@ class InvalidToken(HTTPException):
 
 
 class LoginInfo(BaseModel):
-    user: User
+    user: User | UserView
     token: Token
 
 
@@ -41,14 +40,28 @@ async def check_token(
     return body
 
 
-async def check_user(
-    token: Annotated[Token, Depends(check_token)],
-    users: Annotated[Collection, Depends(collection_depends("users"))]
-) -> LoginInfo:
-    user = await get_user(token.sub)
+@cache
+def user_depends(
+    view: type[User | UserView] = User
+) -> Callable[..., Awaitable[LoginInfo]]:
+    """
+    Dependency that loads only the fields of the user declared on the view.
+    Returns the same callable for the same view so FastAPI resolves it once
+    per request.
+    """
+
+    async def check_user(
+        token: Annotated[Token, Depends(check_token)]
+    ) -> LoginInfo:
+        user = await get_cached_user(token.sub, view)
+
+        if not user:
+            logger.warning("User %s not found: %s", token.sub, token)
+            raise InvalidToken()
+
+        return LoginInfo(user=user, token=token)
+
+    return check_user
 
-    if not user:
-        logger.warning("User %s not found: %s", token.sub, token)
-        raise InvalidToken()
 
-    return LoginInfo(user=user, token=token)
+check_user = user_depends(User)
@@ -0,0 +1,54 @@
+from kokomemo.db import get_collection
+from fastapi import HTTPException, Request, Response
+from hashlib import sha256
+
+
+class NotModified(HTTPException):
+    def __init__(self, etag: str):
+        super().__init__(status_code=304, headers={"ETag": etag})
+
+
+def make_etag(*parts) -> str:
+    digest = sha256("/".join(map(str, parts)).encode()).hexdigest()
+    return f'"{digest[:32]}"'
+
+
+def check_etag(request: Request, response: Response, etag: str) -> None:
+    """
+    Raises 304 if the client already has this version, otherwise attaches
+    the ETag to the response
+    """
+
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match:
+        # Weak comparison, as If-None-Match requires
+        tags = {tag.strip().removeprefix("W/")
+                for tag in if_none_match.split(",")}
+        if etag in tags or "*" in tags:
+            raise NotModified(etag)
+
+    response.headers["ETag"] = etag
+
+
+async def get_user_version(user_id: str) -> int:
+    """
+    The counter bumped whenever the user's profile or walls change
+    """
+
+    user = await get_collection("users", read_only=True).find_one(
+        {"id": user_id}, {"version": 1}
+    ) or {}
+    return user.get('version', 0)
+
+
+async def get_wall_version(user_id: str, wall_id: str) -> int | None:
+    """
+    Bumped whenever memos on the wall change, None if there's no such wall
+    """
+
+    wall = await get_collection("walls", read_only=True).find_one(
+        {"user_id": user_id, "id": wall_id}, {"memo_version": 1}
+    )
+    if not wall:
+        return None
+    return wall.get('memo_version', 0)
@@ -0,0 +1,89 @@
+from .config import config
+from .logger import logger
+from google.auth import jwt
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from time import monotonic
+import asyncio
+import re
+import requests
+
+GOOGLE_ISSUERS = ("accounts.google.com", "https://accounts.google.com")
+MAX_AGE = re.compile(r"max-age=(\d+)")
+
+# Signature checks and certificate fetches block, so they get their own
+# bounded pool instead of competing for the default executor
+executor = ThreadPoolExecutor(
+    max_workers=config.google_verify_workers,
+    thread_name_prefix="google-verify"
+)
+
+
+class CertCache:
+    """
+    Google's signing certificates, kept until their Cache-Control max-age
+    runs out. Concurrent requests on a cold cache share a single fetch.
+    """
+
+    def __init__(self, url: str, timeout: float = 10):
+        self.url = url
+        self.timeout = timeout
+        self.certs: dict | None = None
+        self.expires_at = 0.0
+        self._lock = asyncio.Lock()
+
+    def _is_fresh(self) -> bool:
+        return self.certs is not None and monotonic() < self.expires_at
+
+    def _fetch(self) -> tuple[dict, int]:
+        response = requests.get(self.url, timeout=self.timeout)
+        response.raise_for_status()
+
+        match = MAX_AGE.search(response.headers.get("Cache-Control", ""))
+        max_age = int(match.group(1)) if match else 0
+
+        return response.json(), max_age
+
+    async def get(self) -> dict:
+        if self._is_fresh():
+            return self.certs
+
+        async with self._lock:
+            # Another request might have fetched them while we waited
+            if self._is_fresh():
+                return self.certs
+
+            try:
+                certs, max_age = await asyncio.get_running_loop() \
+                    .run_in_executor(executor, self._fetch)
+            except (requests.RequestException, ValueError):
+                if self.certs is None:
+                    raise
+                logger.exception("Failed to refresh Google certs, reusing:")
+                return self.certs
+
+            logger.debug("Fetched Google certs, valid for %ds", max_age)
+            self.certs = certs
+            self.expires_at = monotonic() + max_age
+
+        return certs
+
+
+cert_cache = CertCache(config.google_certs_url)
+
+
+async def verify_google_token(token: str, audience: str | None) -> dict:
+    """
+    Same checks as `id_token.verify_oauth2_token`, with cached certificates
+    """
+
+    certs = await cert_cache.get()
+
+    idinfo = await asyncio.get_running_loop().run_in_executor(
+        executor, partial(jwt.decode, token, certs=certs, audience=audience)
+    )
+
+    if idinfo['iss'] not in GOOGLE_ISSUERS:
+        raise ValueError(f"Wrong issuer {idinfo['iss']}")
+
+    return idinfo
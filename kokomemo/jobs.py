@@ -0,0 +1,164 @@
+from .db import get_collection
+from .auth import get_new_id
+from .models import Job
+from .logger import logger
+from pymongo import ReturnDocument
+from collections.abc import Awaitable, Callable
+from datetime import datetime, timedelta, UTC
+import asyncio
+
+# A running job that hasn't reported progress for this many seconds is
+# assumed to have lost its worker and gets picked up by another one
+JOB_LEASE = 60
+
+Handler = Callable[[Job], Awaitable[None]]
+
+handlers: dict[str, Handler] = {}
+_tasks: set[asyncio.Task] = set()
+
+
+class JobDeferred(Exception):
+    """
+    Raised by a handler that can't run yet. The job goes back to pending
+    and is picked up again by `spawn` or `watch_jobs`.
+    """
+
+
+def job_handler(type: str) -> Callable[[Handler], Handler]:
+    def register(handler: Handler) -> Handler:
+        handlers[type] = handler
+        return handler
+
+    return register
+
+
+def claimable(now: datetime) -> dict:
+    return {"$or": [
+        {"status": "pending"},
+        {
+            "status": "running",
+            "heartbeat_at": {"$lt": now - timedelta(seconds=JOB_LEASE)}
+        }
+    ]}
+
+
+async def create_job(
+    user_id: str, type: str, start: bool = True, **params
+) -> Job:
+    """
+    Stores the job so it survives restarts, then starts it in the background
+    unless `start` is off. Left alone, it's picked up by `watch_jobs`.
+    """
+
+    job = Job(id=get_new_id(), user_id=user_id, type=type, params=params)
+    await get_collection("jobs").insert_one(job.model_dump())
+    if start:
+        spawn(job.id)
+
+    return job
+
+
+async def discard_job(job: Job) -> None:
+    """
+    Removes a job that turned out to have nothing to do before it ran
+    """
+
+    await get_collection("jobs").delete_one({"id": job.id})
+
+
+async def get_job(user_id: str, job_id: str) -> Job | None:
+    data = await get_collection("jobs").find_one(
+        {"user_id": user_id, "id": job_id}
+    )
+    return Job(**data) if data else None
+
+
+async def report(job: Job, progress: int) -> None:
+    """
+    Records progress, which also keeps the job claimed by this worker
+    """
+
+    job.progress = progress
+    job.heartbeat_at = datetime.now(UTC)
+
+    await get_collection("jobs").update_one(
+        {"id": job.id},
+        {"$set": {"progress": progress, "heartbeat_at": job.heartbeat_at}}
+    )
+
+
+async def run_job(job_id: str) -> None:
+    jobs = get_collection("jobs")
+    now = datetime.now(UTC)
+
+    data = await jobs.find_one_and_update(
+        {"id": job_id, **claimable(now)},
+        {"$set": {"status": "running", "heartbeat_at": now}},
+        return_document=ReturnDocument.AFTER
+    )
+    if not data:
+        return
+
+    job = Job(**data)
+    logger.info("Running job %s (%s)", job.id, job.type)
+
+    try:
+        await handlers[job.type](job)
+    except asyncio.CancelledError:
+        raise
+    except JobDeferred:
+        logger.info("Job %s deferred", job.id)
+        await jobs.update_one({"id": job.id}, {"$set": {"status": "pending"}})
+        return
+    except Exception as e:
+        logger.exception("Job %s failed:", job.id)
+        update = {"status": "failed", "error": str(e)}
+    else:
+        logger.info("Job %s done, progress %d", job.id, job.progress)
+        update = {"status": "done"}
+
+    await jobs.update_one(
+        {"id": job.id},
+        {"$set": {**update, "finished_at": datetime.now(UTC)}}
+    )
+
+
+def spawn(job_id: str) -> None:
+    task = asyncio.create_task(run_job(job_id))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+
+async def resume_jobs() -> int:
+    """
+    Starts jobs that are pending or were left behind by a dead worker
+    """
+
+    cursor = get_collection("jobs").find(
+        claimable(datetime.now(UTC)), {"id": 1}
+    )
+    job_ids = [job['id'] async for job in cursor]
+
+    for job_id in job_ids:
+        spawn(job_id)
+
+    return len(job_ids)
+
+
+async def watch_jobs() -> None:
+    while True:
+        try:
+            resumed = await resume_jobs()
+            if resumed:
+                logger.info("Resumed %d jobs", resumed)
+        except Exception:
+            logger.exception("Failed to resume jobs:")
+
+        await asyncio.sleep(JOB_LEASE)
+
+
+async def stop_jobs() -> None:
+    for task in list(_tasks):
+        task.cancel()
+
+    await asyncio.gather(*_tasks, return_exceptions=True)
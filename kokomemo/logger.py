@@ -1,25 +1,102 @@
 from .config import config
+from contextvars import ContextVar
+from datetime import datetime, UTC
+from queue import SimpleQueue
+import atexit
+import copy
+import json
 import logging
-from logging import StreamHandler, FileHandler
+from logging import StreamHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+# ID of the request being handled, set by the access log middleware
+request_id: ContextVar[str | None] = ContextVar("request_id", default=None)
 
 logger = logging.getLogger(config.app_name)
 logger.setLevel(config.loglevel)
 
 asyncio_logger = logging.getLogger("asyncio")
 
-formatter = logging.Formatter(
-    fmt="%(levelname)s | %(asctime)s | "
-    "%(funcName)s (%(filename)s:%(lineno)d): %(message)s"
-)
+# Attributes every LogRecord has, anything else came in through extra=
+RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {
+    "message", "asctime", "request_id"
+}
+
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not hasattr(record, "request_id"):
+            record.request_id = request_id.get()
+        return True
+
+
+class LocalQueueHandler(QueueHandler):
+    """
+    Renders the message right away, before its arguments can change, but
+    keeps exc_info. The stock handler folds tracebacks into the message for
+    pickling, and this queue never leaves the process.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.message = record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, UTC).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "request_id": getattr(record, "request_id", None),
+            "location": f"{record.funcName} "
+                        f"({record.filename}:{record.lineno})"
+        }
+        entry.update({
+            key: value for key, value in vars(record).items()
+            if key not in RECORD_ATTRS
+        })
+
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+if config.log_json:
+    formatter = JSONFormatter()
+else:
+    formatter = logging.Formatter(
+        fmt="%(levelname)s | %(asctime)s | "
+        "%(funcName)s (%(filename)s:%(lineno)d): %(message)s"
+    )
 
 stream_handler = StreamHandler()
 stream_handler.setFormatter(formatter)
-
-logger.addHandler(stream_handler)
-asyncio_logger.addHandler(stream_handler)
+handlers: list[logging.Handler] = [stream_handler]
 
 if config.logfile:
-    file_handler = FileHandler(config.logfile, encoding="utf-8")
+    file_handler = RotatingFileHandler(
+        config.logfile, encoding="utf-8",
+        maxBytes=config.logfile_max_bytes, backupCount=config.logfile_backups
+    )
     file_handler.setFormatter(formatter)
+    handlers.append(file_handler)
+
+# Records are only queued on the event loop, writing them to stderr and
+# disk happens on the listener's thread
+queue: SimpleQueue = SimpleQueue()
+queue_handler = LocalQueueHandler(queue)
+queue_handler.addFilter(RequestIdFilter())
+
+listener = QueueListener(queue, *handlers, respect_handler_level=True)
+listener.start()
+atexit.register(listener.stop)
 
-    logger.addHandler(file_handler)
+logger.addHandler(queue_handler)
+asyncio_logger.addHandler(queue_handler)
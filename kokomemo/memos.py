@@ -0,0 +1,429 @@
+from .auth import get_new_id
+from .config import config
+from .db import get_collection
+from .jobs import job_handler, report, JobDeferred, JOB_LEASE
+from .models import Wall, Memo, Job
+from .logger import logger
+from motor.motor_asyncio import AsyncIOMotorCollection as Collection
+from pymongo import UpdateOne, ASCENDING, DESCENDING
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from datetime import datetime, timedelta, UTC
+from math import floor
+from time import monotonic
+import asyncio
+
+# IDs carry 72 random bits and memos and walls have unique indexes on them,
+# so a collision is retried with a fresh ID instead of checking every
+# existing one first.
+ID_ATTEMPTS = 5
+
+# Moves land halfway between their neighbours. Once neighbours get closer
+# than REBALANCE_GAP the wall is renumbered in the background, and a move
+# that would leave less than MIN_INDEX_GAP renumbers it before proceeding,
+# well before float precision runs out.
+REBALANCE_GAP = 1e-6
+MIN_INDEX_GAP = 1e-9
+REBALANCE_BATCH = 1000
+REBALANCE_ATTEMPTS = 5
+# Seconds a rebalance may hold a wall without writing a batch, after which
+# a crashed one is assumed gone. Waiters check back every REBALANCE_POLL.
+REBALANCE_LEASE = 30
+REBALANCE_POLL = 0.05
+PURGE_BATCH = 1000
+
+_rebalancing: set[tuple[str, str]] = set()
+
+
+def content_size(content: str) -> int:
+    return len(content.encode())
+
+
+async def charge_usage(user_id: str, size: int) -> bool:
+    """
+    Adds `size` bytes to the user's storage usage, unless that takes it
+    over the quota. The check is part of the update's filter, so it costs
+    no extra query and can't race other writes. Refunds always succeed.
+    """
+
+    if size == 0:
+        return True
+
+    condition = {"id": user_id}
+    if size > 0 and config.user_quota_bytes is not None:
+        # $not also matches users who have no used_bytes yet
+        condition['used_bytes'] = {
+            "$not": {"$gt": config.user_quota_bytes - size}
+        }
+
+    result = await get_collection("users").update_one(
+        condition, {"$inc": {"used_bytes": size}}
+    )
+    return result.matched_count == 1
+
+
+async def insert_memo(memos: Collection, memo: Memo) -> Memo:
+    """
+    Inserts the memo, drawing a new ID whenever the current one is taken
+    """
+
+    for _ in range(ID_ATTEMPTS):
+        try:
+            await memos.insert_one(memo.model_dump())
+            return memo
+        except DuplicateKeyError:
+            memo.id = get_new_id(token_len=12)
+
+    raise RuntimeError("Failed to allocate a memo ID")
+
+
+async def insert_wall(walls: Collection, wall: Wall) -> Wall:
+    """
+    `insert_memo` for walls
+    """
+
+    for _ in range(ID_ATTEMPTS):
+        try:
+            await walls.insert_one(wall.model_dump())
+            return wall
+        except DuplicateKeyError:
+            wall.id = get_new_id()
+
+    raise RuntimeError("Failed to allocate a wall ID")
+
+
+async def wall_exists(walls: Collection, user_id: str, wall_id: str) -> bool:
+    """
+    Answered from the (user_id, id) index alone
+    """
+
+    return await walls.find_one(
+        {"user_id": user_id, "id": wall_id}, {"_id": 0, "id": 1}
+    ) is not None
+
+
+async def insert_memos(memos: Collection, new_memos: list[Memo]) -> None:
+    """
+    Inserts all memos in one round trip, retrying only the ones whose ID
+    turned out to be taken
+    """
+
+    pending = new_memos
+
+    for _ in range(ID_ATTEMPTS):
+        try:
+            await memos.insert_many(
+                [memo.model_dump() for memo in pending], ordered=False
+            )
+            return
+        except BulkWriteError as e:
+            errors = e.details['writeErrors']
+            if any(error['code'] != 11000 for error in errors):
+                raise
+
+            pending = [pending[error['index']] for error in errors]
+            for memo in pending:
+                memo.id = get_new_id(token_len=12)
+
+    raise RuntimeError("Failed to allocate memo IDs")
+
+
+async def next_index(memos: Collection, user_id: str, wall_id: str) -> float:
+    """
+    Index that places a new memo on top of the wall
+    """
+
+    latest = await memos.find_one(
+        {"user_id": user_id, "wall_id": wall_id},
+        {"index": 1},
+        sort=[("index", DESCENDING)]
+    )
+
+    return floor(latest['index']) + 1.0 if latest else 1.0
+
+
+async def place_after(
+    memos: Collection, user_id: str, wall_id: str,
+    after: str, moving: list[str]
+) -> tuple[list[float], float] | None:
+    """
+    Finds indexes that put `moving` right below the memo `after`, in order,
+    or on top of the wall if `after` is empty. Returns the indexes and the
+    gap left between them, or None if `after` doesn't exist.
+    """
+
+    for _ in range(2):
+        # A wall being rebalanced is out of order until it's done
+        await wait_for_rebalance(user_id, wall_id)
+
+        if not after:
+            top = await memos.find_one(
+                {"user_id": user_id, "wall_id": wall_id,
+                 "id": {"$nin": moving}},
+                {"index": 1},
+                sort=[("index", DESCENDING)]
+            )
+            base = floor(top['index']) + 1.0 if top else 1.0
+            count = len(moving)
+            return [base + count - 1 - i for i in range(count)], 1.0
+
+        target = await memos.find_one(
+            {"user_id": user_id, "wall_id": wall_id, "id": after},
+            {"index": 1}
+        )
+        if not target:
+            return None
+
+        upper = target['index']
+        # The next memo in (index, id) order, like get_memos pages. If it
+        # shares the target's index there's no room and the gap below is 0.
+        below = await memos.find_one(
+            {"user_id": user_id, "wall_id": wall_id,
+             "id": {"$nin": moving},
+             "$or": [
+                 {"index": {"$lt": upper}},
+                 {"index": upper, "id": {"$lt": after}}
+             ]},
+            {"index": 1},
+            sort=[("index", DESCENDING), ("id", DESCENDING)]
+        )
+        lower = below['index'] if below else upper - 1.0
+
+        gap = (upper - lower) / (len(moving) + 1)
+        indexes = [upper - gap * (i + 1) for i in range(len(moving))]
+        bounds = [upper, *indexes, lower]
+
+        if gap >= MIN_INDEX_GAP and all(
+            a > b for a, b in zip(bounds, bounds[1:])
+        ):
+            return indexes, gap
+
+        logger.info("No room left after %s, rebalancing %s", after, wall_id)
+        await rebalance_wall(memos, user_id, wall_id)
+
+    raise RuntimeError(f"Failed to place memos after {after}")
+
+
+async def take_rebalance_lease(user_id: str, wall_id: str) -> str | None:
+    """
+    Marks the wall as being rebalanced, unless another rebalance holds it.
+    Returns the lease to renew and release it with.
+    """
+
+    lease = get_new_id()
+    now = datetime.now(UTC)
+    result = await get_collection("walls").update_one(
+        {"user_id": user_id, "id": wall_id,
+         "rebalance.until": {"$not": {"$gt": now}}},
+        {"$set": {"rebalance": {
+            "id": lease, "until": now + timedelta(seconds=REBALANCE_LEASE)
+        }}}
+    )
+    return lease if result.matched_count == 1 else None
+
+
+async def renew_rebalance_lease(
+    user_id: str, wall_id: str, lease: str
+) -> None:
+    result = await get_collection("walls").update_one(
+        {"user_id": user_id, "id": wall_id, "rebalance.id": lease},
+        {"$set": {"rebalance.until": datetime.now(UTC) + timedelta(
+            seconds=REBALANCE_LEASE
+        )}}
+    )
+    if result.matched_count != 1:
+        raise RuntimeError(f"Lost the rebalance lease on {wall_id}")
+
+
+async def release_rebalance_lease(
+    user_id: str, wall_id: str, lease: str
+) -> None:
+    await get_collection("walls").update_one(
+        {"user_id": user_id, "id": wall_id, "rebalance.id": lease},
+        {"$unset": {"rebalance": ""}}
+    )
+
+
+async def wait_for_rebalance(user_id: str, wall_id: str) -> None:
+    """
+    Returns once no rebalance holds the wall, or its lease would have run out
+    """
+
+    deadline = monotonic() + REBALANCE_LEASE
+    while monotonic() < deadline:
+        busy = await get_collection("walls").find_one(
+            {"user_id": user_id, "id": wall_id,
+             "rebalance.until": {"$gt": datetime.now(UTC)}},
+            {"_id": 1}
+        )
+        if not busy:
+            return
+        await asyncio.sleep(REBALANCE_POLL)
+
+
+async def rebalance_wall(memos: Collection, user_id: str, wall_id: str) -> int:
+    """
+    Renumbers the wall to consecutive integer indexes keeping its order.
+    The wall is out of order until every batch is written, so this holds a
+    lease on it that other rebalances and `place_after` wait out. Starts
+    over if other memo writes land on the wall while it reads, and never
+    overwrites an index that changed since. Returns the number of memos
+    rewritten.
+    """
+
+    for _ in range(REBALANCE_ATTEMPTS):
+        lease = await take_rebalance_lease(user_id, wall_id)
+        if lease is None:
+            if await get_memo_version(user_id, wall_id) is None:
+                return 0
+            await wait_for_rebalance(user_id, wall_id)
+            continue
+
+        try:
+            moved = await renumber_wall(memos, user_id, wall_id, lease)
+        finally:
+            await release_rebalance_lease(user_id, wall_id, lease)
+
+        if moved is not None:
+            return moved
+
+    raise RuntimeError(f"{wall_id} kept changing while rebalancing")
+
+
+async def renumber_wall(
+    memos: Collection, user_id: str, wall_id: str, lease: str
+) -> int | None:
+    """
+    One attempt of `rebalance_wall`, None if the wall changed while reading
+    """
+
+    version = await get_memo_version(user_id, wall_id)
+
+    cursor = memos.find(
+        {"user_id": user_id, "wall_id": wall_id}, {"id": 1, "index": 1}
+    ).sort([("index", ASCENDING), ("id", ASCENDING)])
+
+    requests = []
+    position = 0.0
+    now = datetime.now(UTC)
+    async for memo in cursor:
+        position += 1.0
+        if memo['index'] != position:
+            requests.append(UpdateOne(
+                {"user_id": user_id, "wall_id": wall_id,
+                 "id": memo['id'], "index": memo['index']},
+                {"$set": {"index": position, "modified_at": now}}
+            ))
+
+    if requests and await get_memo_version(user_id, wall_id) != version:
+        logger.info("%s changed while rebalancing, starting over", wall_id)
+        return None
+
+    if requests:
+        # Before the first write too, so pages read from the half-written
+        # wall never share an ETag with the finished one
+        await bump_wall_version(user_id, wall_id)
+
+    for start in range(0, len(requests), REBALANCE_BATCH):
+        await renew_rebalance_lease(user_id, wall_id, lease)
+        await memos.bulk_write(
+            requests[start:start + REBALANCE_BATCH], ordered=False
+        )
+
+    if requests:
+        await bump_wall_version(user_id, wall_id)
+
+    logger.info("Rebalanced %s, %d memos moved", wall_id, len(requests))
+    return len(requests)
+
+
+async def rebalance_in_background(
+    memos: Collection, user_id: str, wall_id: str
+) -> None:
+    """
+    `rebalance_wall` for background tasks, skipping walls already in progress
+    """
+
+    key = (user_id, wall_id)
+    if key in _rebalancing:
+        return
+
+    _rebalancing.add(key)
+    try:
+        await rebalance_wall(memos, user_id, wall_id)
+    except Exception:
+        logger.exception("Failed to rebalance %s:", wall_id)
+    finally:
+        _rebalancing.discard(key)
+
+
+@job_handler("purge_wall")
+async def purge_wall(job: Job) -> None:
+    """
+    Deletes the memos of a deleted wall a batch at a time
+    """
+
+    memos = get_collection("memos")
+    condition = {"user_id": job.user_id, "wall_id": job.params['wall_id']}
+    deleted = job.progress
+
+    # The job is stored before the wall is deleted. A worker may claim it
+    # in between, so a recent job waits for the deletion. Otherwise the
+    # deletion never happened and the memos must stay.
+    if await wall_exists(
+        get_collection("walls"), job.user_id, job.params['wall_id']
+    ):
+        if datetime.now(UTC) - job.created_at < timedelta(seconds=JOB_LEASE):
+            raise JobDeferred()
+        logger.warning(
+            "Wall %s still exists, not purging it", job.params['wall_id']
+        )
+        return
+
+    while True:
+        cursor = memos.find(condition, {"id": 1, "content": 1}) \
+            .limit(PURGE_BATCH)
+        batch = [memo async for memo in cursor]
+        if not batch:
+            break
+
+        result = await memos.delete_many(
+            {**condition, "id": {"$in": [memo['id'] for memo in batch]}}
+        )
+        # Nothing else deletes memos of a deleted wall, so every memo
+        # found here is gone now
+        await charge_usage(job.user_id, -sum(
+            content_size(memo.get('content', "")) for memo in batch
+        ))
+        deleted += result.deleted_count
+        await report(job, deleted)
+
+
+async def get_memo_version(user_id: str, wall_id: str) -> int | None:
+    """
+    `memo_version` read from the primary, for writers that need it current
+    """
+
+    wall = await get_collection("walls").find_one(
+        {"user_id": user_id, "id": wall_id}, {"memo_version": 1}
+    )
+    return wall.get('memo_version', 0) if wall else None
+
+
+async def bump_wall_version(
+    user_id: str, wall_id: str, count: int = 0,
+    modified_at: datetime | None = None
+) -> None:
+    """
+    Invalidates ETags of the wall's memo pages, adding `count` to its memo
+    count and moving its last activity up to `modified_at` on the way
+    """
+
+    update = {"$inc": {"memo_version": 1}}
+    if count:
+        update['$inc']['memo_count'] = count
+    if modified_at is not None:
+        update['$max'] = {"last_memo_at": modified_at}
+
+    await get_collection("walls").update_one(
+        {"user_id": user_id, "id": wall_id}, update
+    )
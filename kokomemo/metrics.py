@@ -0,0 +1,256 @@
+from bisect import bisect_left
+from threading import Lock
+from time import perf_counter
+from pymongo import monitoring
+
+DEFAULT_BUCKETS = (
+    .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0
+)
+
+# Prometheus metrics without the client library. Every observation takes
+# one uncontended lock: pymongo calls the listeners from its own threads,
+# where bare increments could get lost.
+registry: list["Metric"] = []
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", r"\\").replace('"', r'\"').replace("\n", r"\n")
+
+
+def format_labels(
+    names: tuple[str, ...], values: tuple, extra: str = ""
+) -> str:
+    pairs = [f'{name}="{escape(str(value))}"'
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.lock = Lock()
+        registry.append(self)
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        return "\n".join([
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} {self.type}",
+            *self.samples()
+        ])
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self) -> list[str]:
+        with self.lock:
+            values = list(self.values.items())
+        return [f"{self.name}{format_labels(self.labels, labels)} {value}"
+                for labels, value in values]
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, *labels, amount: float = 1) -> None:
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, *args, buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+                 **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = buckets
+        # Per bucket counts, not cumulative, then +Inf and the sum
+        self.series: dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels) -> None:
+        bucket = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = \
+                    [0] * (len(self.buckets) + 1) + [0.0]
+            series[bucket] += 1
+            series[-1] += value
+
+    def samples(self) -> list[str]:
+        with self.lock:
+            all_series = [(labels, series.copy())
+                          for labels, series in self.series.items()]
+
+        lines = []
+        for labels, series in all_series:
+            count = 0
+            for bound, observed in zip((*self.buckets, "+Inf"), series):
+                count += observed
+                le = format_labels(self.labels, labels, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{le} {count}")
+            names = format_labels(self.labels, labels)
+            lines.append(f"{self.name}_count{names} {count}")
+            lines.append(f"{self.name}_sum{names} {series[-1]}")
+        return lines
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+http_requests = Counter(
+    "kokomemo_http_requests_total", "HTTP requests handled",
+    ("method", "route", "status")
+)
+http_duration = Histogram(
+    "kokomemo_http_request_duration_seconds",
+    "Time from receiving a request to sending the last of its response",
+    ("method", "route")
+)
+http_in_flight = Gauge(
+    "kokomemo_http_requests_in_flight", "HTTP requests being handled"
+)
+mongo_duration = Histogram(
+    "kokomemo_mongodb_command_duration_seconds",
+    "MongoDB command round trips, failed ones included",
+    ("command", "collection")
+)
+mongo_failures = Counter(
+    "kokomemo_mongodb_command_failures_total", "MongoDB commands that failed",
+    ("command", "collection")
+)
+mongo_checkout_wait = Histogram(
+    "kokomemo_mongodb_pool_checkout_wait_seconds",
+    "Time spent waiting for a pooled connection",
+    buckets=(.0001, .0005, .001, .005, .01, .05, .1, .5, 1.0, 5.0)
+)
+mongo_checked_out = Gauge(
+    "kokomemo_mongodb_connections_checked_out",
+    "Pooled connections currently in use"
+)
+
+
+def route_label(scope) -> str:
+    """
+    The template of the matched route, so IDs in paths don't explode the
+    number of series
+    """
+
+    template = getattr(scope.get('route'), 'path', None)
+    if template is None:
+        return "unmatched"
+
+    # Routes of included routers may only know their own part of the path.
+    # Their prefixes have no parameters, so take them from the request.
+    depth = template.count("/")
+    prefix = scope['path'].rsplit("/", depth)[0] if depth else scope['path']
+    return prefix + template
+
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != "http":
+            return await self.app(scope, receive, send)
+
+        start = perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message['type'] == "http.response.start":
+                status = message['status']
+            await send(message)
+
+        http_in_flight.inc()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            http_in_flight.dec()
+            route = route_label(scope)
+            http_duration.observe(
+                perf_counter() - start, scope['method'], route
+            )
+            http_requests.inc(scope['method'], route, status)
+
+
+class CommandMetrics(monitoring.CommandListener):
+    def __init__(self):
+        # Collections by request ID, only the started event carries them
+        self.collections: dict[int, str] = {}
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        target = event.command.get(event.command_name)
+        if event.command_name == "getMore":
+            target = event.command.get("collection")
+        if isinstance(target, str):
+            self.collections[event.request_id] = target
+
+    def finish(self, event, failed: bool) -> None:
+        labels = (
+            event.command_name, self.collections.pop(event.request_id, "")
+        )
+        mongo_duration.observe(event.duration_micros / 1e6, *labels)
+        if failed:
+            mongo_failures.inc(*labels)
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        self.finish(event, False)
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        self.finish(event, True)
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    def connection_checked_out(self, event):
+        mongo_checkout_wait.observe(event.duration)
+        mongo_checked_out.inc()
+
+    def connection_check_out_failed(self, event):
+        mongo_checkout_wait.observe(event.duration)
+
+    def connection_checked_in(self, event):
+        mongo_checked_out.dec()
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
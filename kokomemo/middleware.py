@@ -0,0 +1,82 @@
+from .config import config
+from .logger import logger, request_id
+from time import perf_counter
+from random import random
+import os
+import re
+
+access_logger = logger.getChild("access")
+
+REQUEST_ID_HEADER = b"x-request-id"
+# Accept the caller's ID only if it's safe to echo back and log as-is
+VALID_REQUEST_ID = re.compile(rb"[A-Za-z0-9._:-]{1,64}")
+
+
+def new_request_id() -> str:
+    return os.urandom(8).hex()
+
+
+class AccessLogMiddleware:
+    """
+    Tags every request with an ID, returned in X-Request-ID, and logs one
+    line per request once its response has been fully sent. Plain ASGI,
+    so streamed responses pass through untouched.
+    """
+
+    def __init__(
+        self, app,
+        enabled: bool = config.access_log,
+        sample_rate: float = config.access_log_sample_rate
+    ):
+        self.app = app
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != "http":
+            return await self.app(scope, receive, send)
+
+        start = perf_counter()
+
+        rid = None
+        for name, value in scope['headers']:
+            if name == REQUEST_ID_HEADER:
+                if VALID_REQUEST_ID.fullmatch(value):
+                    rid = value.decode()
+                break
+        if rid is None:
+            rid = new_request_id()
+
+        status = 500
+
+        async def send_with_id(message):
+            nonlocal status
+            if message['type'] == "http.response.start":
+                status = message['status']
+                message = {**message, "headers": [
+                    *message.get('headers', ()),
+                    (REQUEST_ID_HEADER, rid.encode())
+                ]}
+            await send(message)
+
+        token = request_id.set(rid)
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            request_id.reset(token)
+
+            if self.enabled and (
+                self.sample_rate >= 1 or random() < self.sample_rate
+            ):
+                duration = (perf_counter() - start) * 1000
+                access_logger.info(
+                    "%s %s %d %.1fms", scope['method'], scope['path'],
+                    status, duration,
+                    extra={
+                        "request_id": rid,
+                        "method": scope['method'],
+                        "path": scope['path'],
+                        "status": status,
+                        "duration_ms": round(duration, 3)
+                    }
+                )
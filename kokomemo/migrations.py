@@ -0,0 +1,422 @@
+from .db import get_collection
+from .config import config
+from .logger import logger
+from pymongo import IndexModel, UpdateOne, ASCENDING, DESCENDING, TEXT
+from pymongo.errors import BulkWriteError, OperationFailure
+from datetime import datetime, UTC
+
+INDEX_NOT_FOUND = 27
+
+# Every entry is one version of the index set. Append a new entry to roll out
+# new indexes; versions already recorded in the database are skipped.
+# A string instead of an IndexModel drops the index with that name.
+INDEXES: list[dict[str, list[IndexModel | str]]] = [
+    {
+        "memos": [
+            IndexModel(
+                [
+                    ("user_id", ASCENDING),
+                    ("wall_id", ASCENDING),
+                    ("index", DESCENDING)
+                ],
+                name="user_wall_index"
+            ),
+            IndexModel("id", unique=True, name="id_unique")
+        ],
+        "users": [
+            IndexModel("id", unique=True, name="id_unique"),
+            IndexModel("email", name="email"),
+            IndexModel(
+                [
+                    ("integrations.service", ASCENDING),
+                    ("integrations.data.id", ASCENDING)
+                ],
+                name="integrations"
+            )
+        ]
+    },
+    {
+        "sessions": [
+            IndexModel(
+                [("user_id", ASCENDING), ("id", ASCENDING)],
+                unique=True, name="user_id_unique"
+            ),
+            IndexModel("expires_at", expireAfterSeconds=0, name="expiry")
+        ]
+    },
+    {
+        "memos": [
+            IndexModel(
+                [
+                    ("user_id", ASCENDING),
+                    ("wall_id", ASCENDING),
+                    ("index", DESCENDING),
+                    ("id", DESCENDING)
+                ],
+                name="user_wall_index_id"
+            ),
+            "user_wall_index"
+        ]
+    },
+    {
+        "jobs": [
+            IndexModel("id", unique=True, name="id_unique"),
+            IndexModel(
+                [("user_id", ASCENDING), ("id", ASCENDING)], name="user_id"
+            ),
+            IndexModel(
+                [("status", ASCENDING), ("heartbeat_at", ASCENDING)],
+                name="status_heartbeat"
+            )
+        ]
+    },
+    {
+        "memos": [
+            IndexModel(
+                [
+                    ("user_id", ASCENDING),
+                    ("modified_at", ASCENDING),
+                    ("id", ASCENDING)
+                ],
+                name="user_modified"
+            )
+        ],
+        "tombstones": [
+            IndexModel(
+                [("user_id", ASCENDING), ("deleted_at", ASCENDING)],
+                name="user_deleted"
+            ),
+            IndexModel(
+                "deleted_at", expireAfterSeconds=config.tombstone_ttl,
+                name="expiry"
+            )
+        ]
+    },
+    {
+        # Only one text index is allowed per collection
+        "memos": [
+            IndexModel(
+                [("user_id", ASCENDING), ("content", TEXT)],
+                name="user_content_text"
+            )
+        ]
+    },
+    {
+        "walls": [
+            IndexModel(
+                [("user_id", ASCENDING), ("id", ASCENDING)],
+                unique=True, name="user_id_unique"
+            ),
+            IndexModel(
+                [
+                    ("user_id", ASCENDING),
+                    ("created_at", DESCENDING),
+                    ("id", DESCENDING)
+                ],
+                name="user_created"
+            ),
+            IndexModel(
+                [("user_id", ASCENDING), ("modified_at", ASCENDING)],
+                name="user_modified"
+            )
+        ]
+    },
+    {
+        # Unfinished jobs have no finished_at and are never expired
+        "jobs": [
+            IndexModel(
+                "finished_at", expireAfterSeconds=config.job_ttl,
+                name="expiry"
+            )
+        ]
+    }
+]
+
+
+async def get_index_version() -> int:
+    state = await get_collection("migrations").find_one({"id": "indexes"})
+    return state['version'] if state else 0
+
+
+async def ensure_indexes() -> int:
+    """
+    Creates every index version newer than the one recorded in the database
+    """
+
+    current = await get_index_version()
+
+    if current >= len(INDEXES):
+        logger.debug("Indexes are up to date (version %d)", current)
+        return current
+
+    for version, collections in enumerate(INDEXES[current:], current + 1):
+        for name, indexes in collections.items():
+            collection = get_collection(name)
+            create = [x for x in indexes if isinstance(x, IndexModel)]
+            drop = [x for x in indexes if isinstance(x, str)]
+
+            if create:
+                logger.info(
+                    "Creating index version %d on %s: %s", version, name,
+                    ", ".join(index.document['name'] for index in create)
+                )
+                await collection.create_indexes(create)
+
+            for index in drop:
+                logger.info(
+                    "Dropping index version %d on %s: %s",
+                    version, name, index
+                )
+                try:
+                    await collection.drop_index(index)
+                except OperationFailure as e:
+                    if e.code != INDEX_NOT_FOUND:
+                        raise
+
+        await get_collection("migrations").update_one(
+            {"id": "indexes"},
+            {"$set": {"version": version, "applied_at": datetime.now(UTC)}},
+            upsert=True
+        )
+
+    return len(INDEXES)
+
+
+async def migrate_sessions(batch_size: int = 500) -> int:
+    """
+    Moves sessions embedded in user documents to the sessions collection.
+    Safe to run again if interrupted.
+    """
+
+    users = get_collection("users")
+    sessions = get_collection("sessions")
+    now = datetime.now(UTC)
+    moved = 0
+
+    cursor = users.find(
+        {"sessions": {"$exists": True}}, {"id": 1, "sessions": 1}
+    ).batch_size(batch_size)
+
+    async for user in cursor:
+        documents = [
+            {**session, "user_id": user['id']}
+            for session in user['sessions'] if session['expires_at'] > now
+        ]
+
+        if documents:
+            try:
+                await sessions.insert_many(documents, ordered=False)
+            except BulkWriteError as e:
+                # Sessions copied by an interrupted run are already there
+                if any(
+                    error['code'] != 11000
+                    for error in e.details['writeErrors']
+                ):
+                    raise
+
+        await users.update_one(
+            {"id": user['id']}, {"$unset": {"sessions": ""}}
+        )
+        moved += len(documents)
+
+    logger.info("Moved %d sessions", moved)
+    return moved
+
+
+async def migrate_walls(batch_size: int = 500) -> int:
+    """
+    Moves walls embedded in user documents to the walls collection.
+    Safe to run again if interrupted.
+    """
+
+    users = get_collection("users")
+    walls = get_collection("walls")
+    moved = 0
+
+    cursor = users.find(
+        {"walls": {"$exists": True}}, {"id": 1, "walls": 1}
+    ).batch_size(batch_size)
+
+    async for user in cursor:
+        documents = [{**wall, "user_id": user['id']} for wall in user['walls']]
+
+        if documents:
+            try:
+                await walls.insert_many(documents, ordered=False)
+            except BulkWriteError as e:
+                # Walls copied by an interrupted run are already there
+                if any(
+                    error['code'] != 11000
+                    for error in e.details['writeErrors']
+                ):
+                    raise
+
+        await users.update_one(
+            {"id": user['id']},
+            {"$unset": {"walls": ""}, "$inc": {"version": 1}}
+        )
+        moved += len(documents)
+
+    logger.info("Moved %d walls", moved)
+    return moved
+
+
+async def sweep_orphans(batch_size: int = 500) -> int:
+    """
+    Deletes memos whose wall or user no longer exists, left behind by wall
+    deletions from before they were cascaded
+    """
+
+    users = get_collection("users")
+    walls = get_collection("walls")
+    memos = get_collection("memos")
+
+    # Every memo of a user whose walls are still embedded would look orphaned
+    if await users.find_one({"walls": {"$exists": True}}, {"id": 1}):
+        raise RuntimeError("Walls haven't been migrated, run migrate-walls")
+
+    # Anything newer might belong to a wall created while we're sweeping
+    started = datetime.now(UTC)
+    removed = 0
+
+    cursor = users.find({}, {"id": 1}).batch_size(batch_size)
+    async for user in cursor:
+        wall_ids = await walls.distinct("id", {"user_id": user['id']})
+        result = await memos.delete_many({
+            "user_id": user['id'],
+            "wall_id": {"$nin": wall_ids},
+            "created_at": {"$lt": started}
+        })
+        removed += result.deleted_count
+
+    user_ids = await memos.distinct("user_id")
+    for start in range(0, len(user_ids), batch_size):
+        batch = user_ids[start:start + batch_size]
+        existing = {
+            user['id'] async for user in
+            users.find({"id": {"$in": batch}}, {"id": 1})
+        }
+        missing = [user_id for user_id in batch if user_id not in existing]
+        if missing:
+            result = await memos.delete_many({
+                "user_id": {"$in": missing}, "created_at": {"$lt": started}
+            })
+            removed += result.deleted_count
+
+    logger.info("Removed %d orphaned memos", removed)
+    return removed
+
+
+async def repair_usage(batch_size: int = 500) -> int:
+    """
+    Recomputes `used_bytes` of every user from their memos, a batch of
+    users at a time. Memo writes racing a batch can leave it off by their
+    size, so run it while things are quiet. Returns the users corrected.
+    """
+
+    users = get_collection("users")
+    memos = get_collection("memos")
+    corrected = 0
+
+    async def repair(batch: list[dict]) -> int:
+        totals = {
+            row['_id']: row['bytes'] async for row in memos.aggregate([
+                {"$match": {"user_id": {"$in": [x['id'] for x in batch]}}},
+                {"$group": {
+                    "_id": "$user_id",
+                    "bytes": {"$sum": {
+                        "$strLenBytes": {"$ifNull": ["$content", ""]}
+                    }}
+                }}
+            ])
+        }
+
+        requests = [
+            UpdateOne(
+                {"id": user['id']},
+                {"$set": {"used_bytes": totals.get(user['id'], 0)}}
+            )
+            for user in batch
+            if user.get('used_bytes') != totals.get(user['id'], 0)
+        ]
+        if requests:
+            await users.bulk_write(requests, ordered=False)
+        return len(requests)
+
+    batch = []
+    cursor = users.find({}, {"id": 1, "used_bytes": 1}).batch_size(batch_size)
+    async for user in cursor:
+        batch.append(user)
+        if len(batch) == batch_size:
+            corrected += await repair(batch)
+            batch = []
+
+    if batch:
+        corrected += await repair(batch)
+
+    logger.info("Corrected storage usage of %d users", corrected)
+    return corrected
+
+
+async def reconcile_walls(batch_size: int = 500) -> int:
+    """
+    Recomputes `memo_count` and `last_memo_at` of every wall from its memos,
+    a batch of walls at a time. Like `repair_usage`, memo writes racing a
+    batch can throw it off, so run it while things are quiet. Returns the
+    walls corrected.
+    """
+
+    walls = get_collection("walls")
+    memos = get_collection("memos")
+    corrected = 0
+
+    async def reconcile(batch: list[dict]) -> int:
+        # Wall IDs are only unique per user, so match both and split after
+        stats = {
+            (row['_id']['user_id'], row['_id']['wall_id']): row
+            async for row in memos.aggregate([
+                {"$match": {
+                    "user_id": {"$in": list({x['user_id'] for x in batch})},
+                    "wall_id": {"$in": list({x['id'] for x in batch})}
+                }},
+                {"$group": {
+                    "_id": {"user_id": "$user_id", "wall_id": "$wall_id"},
+                    "count": {"$sum": 1},
+                    "last": {"$max": "$modified_at"}
+                }}
+            ])
+        }
+
+        requests = []
+        for wall in batch:
+            row = stats.get((wall['user_id'], wall['id']), {})
+            count, last = row.get('count', 0), row.get('last')
+            if wall.get('memo_count') != count or \
+                    wall.get('last_memo_at') != last:
+                requests.append(UpdateOne(
+                    {"user_id": wall['user_id'], "id": wall['id']},
+                    {
+                        "$set": {"memo_count": count, "last_memo_at": last},
+                        "$inc": {"memo_version": 1}
+                    }
+                ))
+
+        if requests:
+            await walls.bulk_write(requests, ordered=False)
+        return len(requests)
+
+    batch = []
+    cursor = walls.find(
+        {}, {"user_id": 1, "id": 1, "memo_count": 1, "last_memo_at": 1}
+    ).batch_size(batch_size)
+    async for wall in cursor:
+        batch.append(wall)
+        if len(batch) == batch_size:
+            corrected += await reconcile(batch)
+            batch = []
+
+    if batch:
+        corrected += await reconcile(batch)
+
+    logger.info("Corrected memo counts of %d walls", corrected)
+    return corrected
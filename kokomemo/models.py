@@ -14,6 +14,7 @@ class Memo(BaseModel):
 
 class Session(BaseModel):
     id: str
+    user_id: str
     current_refresh_id: str
     created_at: datetime
     expires_at: datetime
@@ -26,8 +27,13 @@ class Integration(BaseModel):
 
 class Wall(BaseModel):
     id: str
+    user_id: str
     name: str
     colour: int
+    memo_version: int = 0
+    # Kept up to date by memo writes, and by `reconcile-walls` if they drift
+    memo_count: int = 0
+    last_memo_at: datetime | None = None
     created_at: datetime = Field(default_factory=lambda: datetime.now(UTC))
     modified_at: datetime = Field(default_factory=lambda: datetime.now(UTC))
 
@@ -37,10 +43,41 @@ class User(BaseModel):
     name: str
     email: str
     used_bytes: int = 0
+    version: int = 0
     created_at: datetime = Field(default_factory=lambda: datetime.now(UTC))
-    sessions: list[Session] = []
     integrations: list[Integration]
-    walls: list[Wall] = []
+
+
+class Tombstone(BaseModel):
+    # "wall" or "memo"
+    type: str
+    id: str
+    user_id: str
+    wall_id: str | None = None
+    deleted_at: datetime = Field(default_factory=lambda: datetime.now(UTC))
+
+
+class Job(BaseModel):
+    id: str
+    user_id: str
+    type: str
+    params: dict = {}
+    # pending, running, done or failed
+    status: str = "pending"
+    progress: int = 0
+    error: str | None = None
+    created_at: datetime = Field(default_factory=lambda: datetime.now(UTC))
+    heartbeat_at: datetime = Field(default_factory=lambda: datetime.now(UTC))
+    finished_at: datetime | None = None
+
+
+class UserView(BaseModel):
+    """
+    Subset of `User` for routes that don't need the whole document.
+    Subclasses declare the fields they need and are loaded with a projection.
+    """
+
+    id: str
 
 
 class Token(BaseModel):